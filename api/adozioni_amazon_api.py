@@ -1,48 +1,319 @@
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+from threading import RLock
+from time import sleep, perf_counter
+from urllib.parse import urlsplit
+from api.indexed_list import IndexedList, indexed
+from api.json_codec import loads, select_list_fields
+from api.response_cache import ResponseCache
+from api.reference_cache import ReferenceCache
+from api.rate_limiter import RateLimitController, RateLimitExceeded
+from utils.log_utils import get_logger, Truncated
+from utils.metrics import get_metrics
+from utils.worker_pool import WorkerPool, get_worker_context
+
+API_BASE_URL = "https://www.adozionilibriscolastici.it"
+THROTTLE_STATUS_CODES = (403, 429, 503)
+REFERENCE_KEYS = ("ID", "VALUE")
+SCUOLE_KEYS = ("COSCUO",)
+CLASSI_KEYS = ("CLID", ("CLASSE", "SEZION"))
+ADOZIONI_KEYS = ("ISBN",)
+PAYLOAD_LOG_SAMPLE = 10  # Solo una risposta su dieci viene registrata a livello DEBUG
+
+logger = get_logger(__name__)
+
+
+class SessionPool:
+    """
+    Process-wide pool of warmed-up HTTP sessions sharing keep-alive connections.
+    Sessions are handed out round-robin and are created (and warmed up) only once,
+    until they are explicitly rotated or the whole pool is refreshed. The warm-up request runs outside
+    the pool lock, so a slow one does not hold up the threads using the other sessions.
+    """
+
+    def __init__(self, url=API_BASE_URL, size=4, pool_maxsize=16, warm_up=True):
+        self._url = url
+        self._size = size
+        self._pool_maxsize = pool_maxsize
+        self._warm_up = warm_up
+        self._lock = RLock()
+        self._sessions = [None] * size
+        self._next_slot = 0
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if self._warm_up:
+            try:
+                session.get(self._url)
+            except requests.RequestException as error:
+                # Sessione comunque utilizzabile: l'errore della richiesta vera passa per retry_session
+                logger.warning("SessionPool: Riscaldamento della sessione su '%s' non riuscito: %r", self._url, error)
+        return session
+
+    def get_session(self):
+        with self._lock:
+            slot = self._next_slot
+            self._next_slot = (self._next_slot + 1) % self._size
+            session = self._sessions[slot]
+        if session is not None:
+            return session
+        logger.debug("SessionPool: Nuova Sessione nello slot %d!", slot)
+        return self._publish(slot, None, self.create_session())
+
+    def rotate_session(self, session=None):
+        """
+        Replace the given session (or the next one in turn) with a fresh one and return it.
+        If another thread has already rotated that session, its replacement is returned instead.
+        """
+        with self._lock:
+            if session is None:
+                slot = self._next_slot
+            else:
+                slot = next((slot for slot, pooled_session in enumerate(self._sessions) if pooled_session is session),
+                            None)
+            old_session = self._sessions[slot] if slot is not None else None
+        if slot is None:
+            return self.get_session()
+        logger.info("SessionPool: Rotazione della sessione nello slot %d!", slot)
+        return self._publish(slot, old_session, self.create_session())
+
+    def _publish(self, slot, expected_session, session):
+        """
+        Store a session created (and warmed up) outside the lock in `slot`, unless another thread has already
+        replaced `expected_session` there: then the other thread's session is kept and this one is closed.
+        """
+        with self._lock:
+            current_session = self._sessions[slot]
+            if current_session is not expected_session and current_session is not None:
+                discarded_session, session = session, current_session
+            else:
+                self._sessions[slot] = session
+                discarded_session = expected_session
+        if discarded_session is not None:
+            discarded_session.close()
+        return session
+
+    def refresh(self):
+        """
+        Drop every pooled session; new ones are created lazily on the next request.
+        """
+        with self._lock:
+            for session in self._sessions:
+                if session is not None:
+                    session.close()
+            self._sessions = [None] * self._size
+            logger.info("SessionPool: Tutte le sessioni sono state rinnovate!")
+
+    def close(self):
+        self.refresh()
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def size(self):
+        return self._size
+
+
+_session_pool = None
+_session_pool_lock = RLock()
+
+
+def get_session_pool():
+    global _session_pool
+    with _session_pool_lock:
+        if _session_pool is None:
+            _session_pool = SessionPool()
+        return _session_pool
+
+
+def configure_session_pool(**kwargs):
+    """
+    Replace the process-wide session pool with one built from the given SessionPool arguments.
+    """
+    global _session_pool
+    with _session_pool_lock:
+        if _session_pool is not None:
+            _session_pool.close()
+        _session_pool = SessionPool(**kwargs)
+        return _session_pool
+
+
+_response_cache = None
+_response_cache_lock = RLock()
+
+
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+
+def configure_response_cache(**kwargs):
+    """
+    Replace the process-wide response cache; `configure_response_cache(enabled=False)` bypasses it.
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is not None:
+            _response_cache.close()
+        _response_cache = ResponseCache(**kwargs)
+        return _response_cache
+
+
+_reference_cache = None
+_reference_cache_lock = RLock()
+
+
+def get_reference_cache():
+    global _reference_cache
+    with _reference_cache_lock:
+        if _reference_cache is None:
+            _reference_cache = ReferenceCache()
+        return _reference_cache
+
+
+def configure_reference_cache(**kwargs):
+    """
+    Replace the process-wide reference cache; `configure_reference_cache(enabled=False)` bypasses it.
+    """
+    global _reference_cache
+    with _reference_cache_lock:
+        _reference_cache = ReferenceCache(**kwargs)
+        return _reference_cache
+
+
+_rate_limiter = None
+_rate_limiter_lock = RLock()
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimitController()
+        return _rate_limiter
+
+
+def configure_rate_limiter(**kwargs):
+    """
+    Replace the process-wide rate-limit controller with one built from the given arguments.
+    """
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = RateLimitController(**kwargs)
+        return _rate_limiter
 
 
 class APIHandler:
-    def __init__(self):
-        self._url = "https://www.adozionilibriscolastici.it"
+    def __init__(self, session_pool=None):
+        self._session_pool = session_pool
         self._session = None
 
+    def get_session_pool(self):
+        if self._session_pool is None:
+            self._session_pool = get_session_pool()
+        return self._session_pool
+
     def get_api_session(self):
         if self._session is None:
-            print("APIHandler: Nuova Sessione!")
+            logger.debug("APIHandler: Nuova Sessione!")
             self._session = self.get_session()
         else:
-            print("APIHandler: Riutilizzo Sessione!")
+            logger.debug("APIHandler: Riutilizzo Sessione!")
         return self._session
 
     def get_session(self):
         """
-        Create and return a session object.
+        Return a warmed-up session from the shared pool.
         """
-        session = requests.Session()
-        session.get(self._url)
-        return session
+        return self.get_session_pool().get_session()
+
+    def rotate_session(self):
+        """
+        Replace the current session in the shared pool with a fresh one.
+        """
+        self._session = self.get_session_pool().rotate_session(self._session)
+        return self._session
+
+    def build_url(self, path):
+        """
+        Resolve an endpoint path against the base URL of the session pool; absolute URLs are returned unchanged.
+        """
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.get_session_pool().url}{path}"
 
 
 def validate_api_handler(api_handler=None):
     if api_handler is None and not isinstance(api_handler, APIHandler):
-        print("APIHandler: Creazione di una nuova istanza!")
+        logger.debug("APIHandler: Creazione di una nuova istanza!")
         api_handler = APIHandler()
     else:
-        print("APIHandler: Riutilizzo dell'istanza!")
+        logger.debug("APIHandler: Riutilizzo dell'istanza!")
     return api_handler
 
 
-def get_data(url, api_handler=None):
+def endpoint_name(url):
+    """
+    Metrics label of a URL: the resource segment after the API version, e.g. 'libri' for /v1/libri/...
+    """
+    segments = urlsplit(url).path.strip("/").split("/")
+    return segments[1] if len(segments) > 1 else segments[0] or "/"
+
+
+def get_data(url, api_handler=None, use_cache=True, fields=None):
     """
-    Fetch data from the specified URL using the provided session.
+    Fetch data from the specified URL (or endpoint path) using the provided session.
+    Cacheable endpoints are served from the local response cache while fresh and revalidated once expired.
+    Returns None for a throttled or failed request.
+    With `fields` (see json_codec.select_fields) only those fields of each returned item are kept.
     """
     list_dict = None
     api_handler = validate_api_handler(api_handler)
+    url = api_handler.build_url(url)
+    metrics = get_metrics()
+    endpoint = endpoint_name(url)
+    response_cache = get_response_cache() if use_cache else None
+    cache_entry = response_cache.lookup(url) if response_cache is not None else None
+    if cache_entry is not None and cache_entry["fresh"]:
+        metrics.increment("http_cache_hits_total", endpoint=endpoint)
+        return select_list_fields(loads(cache_entry["body"]), fields)
+
     session = api_handler.get_api_session()
-    response = session.get(url)
-    if response.status_code == 200:
-        list_dict = response.json()
+    headers = response_cache.revalidation_headers(cache_entry) if response_cache is not None else {}
+    rate_limiter = get_rate_limiter()
+    try:
+        with rate_limiter.request():
+            start = perf_counter()
+            response = session.get(url, headers=headers)
+            metrics.observe("http_request_seconds", perf_counter() - start, endpoint=endpoint)
+    except requests.RequestException as error:
+        # Connessione rifiutata o scaduta: trattata come una limitazione, la riprova spetta a retry_session
+        metrics.increment("http_responses_total", endpoint=endpoint, status="error")
+        rate_limiter.on_throttle()
+        logger.warning("APIHandler: Richiesta a '%s' non riuscita: %r", url, error)
+        return None
+    metrics.increment("http_responses_total", endpoint=endpoint, status=response.status_code)
+    if response.status_code in THROTTLE_STATUS_CODES:
+        rate_limiter.on_throttle()
+    elif response.status_code in (200, 304):
+        rate_limiter.on_success()
+
+    if response.status_code == 304 and cache_entry is not None:
+        response_cache.refresh(url)
+        list_dict = select_list_fields(loads(cache_entry["body"]), fields)
+    elif response.status_code == 200:
+        list_dict = select_list_fields(loads(response.content), fields)
+        if response_cache is not None:
+            response_cache.store(url, response.content, response.headers.get("ETag"),
+                                 response.headers.get("Last-Modified"))
     return list_dict
 
 
@@ -52,8 +323,11 @@ def get_public_ip():
     """
     url = "https://api.ipify.org"
     session = requests.Session()
-    response = session.get(url)
     public_ip = None
+    try:
+        response = session.get(url, timeout=10)
+    except requests.RequestException:
+        return public_ip
     if response.status_code == 200:
         public_ip = response.text
     return public_ip
@@ -72,15 +346,42 @@ def get_regioni():
             "Sicilia": "19", "Sardegna": "20"}
 
 
+def province_path(region_id):
+    return f"/v1/regioni/{region_id}"
+
+
+def comuni_path(province_id):
+    return f"/v1/province/{province_id}"
+
+
+def gradi_path(comune_id):
+    return f"/v1/comuni/{comune_id}"
+
+
+def scuole_grado_path(comune_id, grado_id):
+    return f"/v1/scuole?locId={comune_id}&grado={grado_id}"
+
+
+def classi_scuola_path(scuola_id):
+    return f"/v1/classi/{scuola_id}"
+
+
+def libri_adottati_path(classe_id, scuola_id):
+    return f"/v1/libri/{classe_id}/{scuola_id}"
+
+
+def libro_path(libro_id):
+    return f"/v1/lookup/{libro_id}"
+
+
 def get_province(region_id="05", api_handler=None):
     """
     Fetch province data for the given region ID.
     Output:
     [{'ID': 'BL', 'VALUE': 'Belluno'}, {...}]
     """
-    api_url = "https://www.adozionilibriscolastici.it/v1/regioni"
-    url = f"{api_url}/{region_id}"
-    return get_data(url, api_handler)
+    return get_reference_cache().get_or_load(
+        ("province", str(region_id)), lambda: indexed(get_data(province_path(region_id), api_handler), REFERENCE_KEYS))
 
 
 def get_comuni(province_id="VR", api_handler=None):
@@ -89,9 +390,8 @@ def get_comuni(province_id="VR", api_handler=None):
     Output:
     [{'ID': 'Affi', 'VALUE': 'Affi'}, {...}]
     """
-    api_url = "https://www.adozionilibriscolastici.it/v1/province"
-    url = f"{api_url}/{province_id}"
-    return get_data(url, api_handler)
+    return get_reference_cache().get_or_load(
+        ("comuni", str(province_id)), lambda: indexed(get_data(comuni_path(province_id), api_handler), REFERENCE_KEYS))
 
 
 def get_gradi(comune_id="Verona", api_handler=None):
@@ -100,9 +400,8 @@ def get_gradi(comune_id="Verona", api_handler=None):
     Output:
     [{'ID': 0, 'VALUE': 'SCUOLA PRIMARIA'}, {...}]
     """
-    api_url = "https://www.adozionilibriscolastici.it/v1/comuni"
-    url = f"{api_url}/{comune_id}"
-    return get_data(url, api_handler)
+    return get_reference_cache().get_or_load(
+        ("gradi", str(comune_id)), lambda: indexed(get_data(gradi_path(comune_id), api_handler), REFERENCE_KEYS))
 
 
 def get_scuole_grado(comune_id="Verona", grado_id=2, api_handler=None):
@@ -114,9 +413,7 @@ def get_scuole_grado(comune_id="Verona", grado_id=2, api_handler=None):
     'LOCSCU': 'Verona', 'NOMSCU': '"ANGELO MESSEDAGLIA"', 'FRZSCU': None,
     'TIPO_SCUOLA': 'LICEO SCIENTIFICO', 'GRADO': 2}, {...}]
     """
-    api_url = "https://www.adozionilibriscolastici.it/v1/scuole"
-    url = f"{api_url}?locId={comune_id}&grado={grado_id}"
-    return get_data(url, api_handler)
+    return indexed(get_data(scuole_grado_path(comune_id, grado_id), api_handler), SCUOLE_KEYS)
 
 
 def get_classi_scuola(scuola_id="VRTF03000V", api_handler=None):
@@ -129,9 +426,7 @@ def get_classi_scuola(scuola_id="VRTF03000V", api_handler=None):
     'CODSPC': None, 'TIPSCU': 'NO', 'ABTEST_NEWIF': 1, 'ABTEST_ENABLED': 1,
     'DES_COMB_CNT': 2}, {...}]
     """
-    api_url = "https://www.adozionilibriscolastici.it/v1/classi"
-    url = f"{api_url}/{scuola_id}"
-    return get_data(url, api_handler)
+    return indexed(get_data(classi_scuola_path(scuola_id), api_handler), CLASSI_KEYS)
 
 
 def get_libri_adottati(classe_id, scuola_id="VRTF03000V", api_handler=None):
@@ -147,14 +442,13 @@ def get_libri_adottati(classe_id, scuola_id="VRTF03000V", api_handler=None):
     'SHOW_USED': 0, 'SHOW_PRIME_NOW_EAN': 0, 'SHOW_PRIME_NOW_COSCUO': 0,
     'DIGITALE': 0}, {...}]
     """
-    api_url = f"https://www.adozionilibriscolastici.it/v1/libri"
-    url = f"{api_url}/{classe_id}/{scuola_id}"
-    return get_data(url, api_handler)
+    return indexed(get_data(libri_adottati_path(classe_id, scuola_id), api_handler), ADOZIONI_KEYS)
 
 
-def get_libro(libro_id, api_handler=None):
+def get_libro(libro_id, api_handler=None, fields=None):
     """
-    Fetch book details by libro ID. Output: [{'ASIN': '8823365953', 'DetailPageURL':
+    Fetch book details by libro ID; pass `fields` to keep only part of each document.
+    Output: [{'ASIN': '8823365953', 'DetailPageURL':
     'https://www.amazon.it/dp/8823365953?tag=adozilibris0f-21&linkCode=ogi&th=1&psc=1', 'Images': {'Primary': {
     'Small': {}, 'Medium': {}, 'Large': {}}}, 'ItemInfo': {'ByLineInfo': {'Contributors': [{'Locale': 'it_IT',
     'Name': 'Cordioli, Doriano', 'Role': 'Autore'}], 'Manufacturer': {'Label': 'Manufacturer', 'Locale': 'it_IT'}},
@@ -186,13 +480,26 @@ def get_libro(libro_id, api_handler=None):
     'Publisher': 'Tramontana', 'ListPrice': {'Amount': '4190', 'FormattedPrice': '41,90\xa0€'},
     'EAN': '9788823365957', 'Label': 'Tramontana', 'Author': ['Cordioli, Doriano']}}]
     """
-    api_url = f"https://www.adozionilibriscolastici.it/v1/lookup"
-    url = f"{api_url}/{libro_id}"
-    return get_data(url, api_handler)
+    return get_data(libro_path(libro_id), api_handler, fields=fields)
+
+
+def get_scuole_grado_listing(comune_id="Verona", grado_id=2, api_handler=None):
+    """
+    get_scuole_grado through the reference cache: resolving any number of schools of the same comune
+    and grado costs one request. Failed (throttled) answers are not kept.
+    """
+    return get_reference_cache().get_or_load(("scuole", str(comune_id), str(grado_id)),
+                                             lambda: get_scuole_grado(comune_id, grado_id, api_handler))
+
+
+def clear_scuole_grado_listings():
+    get_reference_cache().invalidate("scuole")
 
 
 def get_scuola(scuola_id="VRTF03000V", comune_id="Verona", grado_id=2, api_handler=None):
-    scuole_grado_comune_dict = get_scuole_grado(comune_id, grado_id, api_handler)
+    scuole_grado_comune_dict = get_scuole_grado_listing(comune_id, grado_id, api_handler)
+    if scuole_grado_comune_dict is None:
+        return None
     scuola_key = "COSCUO"
     return [get_dict_from_id(scuole_grado_comune_dict, scuola_id, scuola_key)]
 
@@ -203,24 +510,76 @@ def fetch_data_from_source(source_function, source_params):
     else:
         source_dict_list = source_function(source_params)
 
-    print(f"APIHandler: '{source_function.__name__}' -> '{source_params}': '{source_dict_list}'")
+    logger.debug("APIHandler: '%s' -> '%s': '%s'", source_function.__name__, Truncated(source_params),
+                 Truncated(source_dict_list), extra={"sample": PAYLOAD_LOG_SAMPLE})
 
     return source_dict_list if source_dict_list is not None else [{}]
 
 
-def retry_session(source_function, source_params):
-    while True:
+def retry_session(source_function, source_params, rate_limiter=None):
+    """
+    Fetch from source_function, retrying an empty (throttled) answer with exponential backoff and jitter
+    on a fresh pooled session. Raises RateLimitExceeded once the retry cap is reached.
+    """
+    rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
+    for attempt in range(rate_limiter.max_retries + 1):
         source_dict_list = fetch_data_from_source(source_function, source_params)
-        if len(source_dict_list) == 1 and not source_dict_list[0]:
-            public_ip = get_public_ip()
-            wait = 5
-            print(f"APIHandler: Accesso API limitato. Attendere {wait} secondi e ottenere una nuova sessione."
-                  f"\nSe il problema persiste, potrebbe essere necessario cambiare l'indirizzo IP ({public_ip}).")
-            sleep(wait)
-            source_params["api_handler"] = APIHandler()
-        else:
+        if not (len(source_dict_list) == 1 and not source_dict_list[0]):
+            return source_dict_list
+        if attempt == rate_limiter.max_retries:
             break
-    return source_dict_list
+        wait = rate_limiter.backoff_delay(attempt)
+        logger.warning("APIHandler: Accesso API limitato. Tentativo %d/%d: attendere %.1f secondi e ottenere "
+                       "una nuova sessione.", attempt + 1, rate_limiter.max_retries, wait)
+        get_metrics().observe("retry_wait_seconds", wait, function=source_function.__name__)
+        sleep(wait)
+        api_handler = validate_api_handler(source_params.get("api_handler"))
+        api_handler.rotate_session()
+        source_params["api_handler"] = api_handler
+
+    public_ip = get_public_ip()
+    raise RateLimitExceeded(f"Accesso API limitato dopo {rate_limiter.max_retries} tentativi per "
+                            f"'{source_function.__name__}'. Potrebbe essere necessario cambiare l'indirizzo IP "
+                            f"({public_ip}).")
+
+
+def preload_regione(regione_id="05", workers=8, gradi_ids=None, scuole=False):
+    """
+    Fill the reference cache with the province, comuni and gradi of a region in one concurrent pass,
+    and with the school listings of every (comune, grado) when `scuole` is set, so that later lookups
+    are served from memory. Returns how many lists were loaded per level and how many failed.
+    """
+    stats = {"province": 0, "comuni": 0, "gradi": 0, "scuole": 0, "errors": 0}
+    stats_lock = RLock()
+
+    def fetch(level, source_function, source_params):
+        source_params["api_handler"] = get_worker_context()
+        source_list = retry_session(source_function, source_params)
+        with stats_lock:
+            stats[level] += 1
+        return source_list
+
+    def preload_comune(comune_id):
+        gradi_list = fetch("gradi", get_gradi, {"comune_id": comune_id})
+        if scuole:
+            for grado_id in get_all_ids_from_dict(gradi_list):
+                if gradi_ids is None or grado_id in gradi_ids:
+                    pool.submit(fetch, "scuole", get_scuole_grado_listing,
+                                {"comune_id": comune_id, "grado_id": grado_id})
+
+    def preload_provincia(provincia_id):
+        comuni_list = fetch("comuni", get_comuni, {"province_id": provincia_id})
+        for comune_id in get_all_ids_from_dict(comuni_list):
+            pool.submit(preload_comune, comune_id)
+
+    with WorkerPool(workers, initializer=APIHandler, name="Preload") as pool:
+        province_list = fetch("province", get_province, {"region_id": regione_id})
+        for provincia_id in get_all_ids_from_dict(province_list):
+            pool.submit(preload_provincia, provincia_id)
+        results = pool.join()
+    stats["errors"] = sum(1 for task in results if task.error is not None)
+    logger.info("APIHandler: Dati di riferimento della regione '%s' precaricati: %s", regione_id, stats)
+    return stats
 
 
 def get_dict_from_id(data_list, search_values, key_id='ID'):
@@ -228,6 +587,8 @@ def get_dict_from_id(data_list, search_values, key_id='ID'):
     Search for the dictionary corresponding to the provided ID in the given data list.
     """
     id_dict = None
+    if isinstance(data_list, IndexedList):
+        return data_list.find(key_id, search_values)
 
     for item in data_list:
         if item.get(key_id) == search_values:
@@ -245,6 +606,10 @@ def get_id_from_dict(data_list, search_values, key_id='ID'):
     if not isinstance(search_values, dict):
         search_values = {'VALUE': search_values}
 
+    if isinstance(data_list, IndexedList) and '' not in search_values.values():
+        item = data_list.match(search_values)  # '' corrisponde anche ai campi mancanti: resta la scansione
+        return item[key_id] if item is not None else None
+
     for item in data_list:
         if all(item.get(key, '') == value for key, value in search_values.items()):
             id_value = item[key_id]
@@ -256,6 +621,8 @@ def get_all_ids_from_dict(data_list, key_id='ID'):
     """
     Extracts all IDs corresponding to the provided key from the given list of dictionaries.
     """
+    if isinstance(data_list, IndexedList):
+        return data_list.ids(key_id)
     id_list = []
     for item in data_list:
         if key_id in item:
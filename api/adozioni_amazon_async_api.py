@@ -0,0 +1,221 @@
+import asyncio
+from contextlib import asynccontextmanager
+from time import perf_counter
+from api.adozioni_amazon_api import (API_BASE_URL, THROTTLE_STATUS_CODES, province_path, comuni_path, gradi_path,
+                                     scuole_grado_path, classi_scuola_path, libri_adottati_path, libro_path,
+                                     get_dict_from_id, get_rate_limiter, endpoint_name)
+from api.json_codec import loads, select_list_fields
+from api.rate_limiter import RateLimitExceeded
+from utils.log_utils import get_logger
+from utils.metrics import get_metrics
+
+try:
+    import aiohttp
+except ImportError:  # dipendenza opzionale, richiesta solo dal motore asincrono
+    aiohttp = None
+
+logger = get_logger(__name__)
+
+SLOT_POLL_INTERVAL = 0.005
+
+
+class AsyncAPIHandler:
+    """
+    Asynchronous counterpart of APIHandler: one aiohttp session with a keep-alive connector,
+    warmed up once, and a semaphore bounding the number of in-flight requests.
+    Requests also go through the shared RateLimitController (or `rate_limiter`), whose AIMD limits
+    are never exceeded whatever `concurrency` is.
+    """
+
+    def __init__(self, url=API_BASE_URL, concurrency=100, warm_up=True, timeout=30, rate_limiter=None):
+        if aiohttp is None:
+            raise RuntimeError("AsyncAPIHandler: il pacchetto 'aiohttp' non è installato!")
+        self._url = url
+        self._concurrency = concurrency
+        self._warm_up = warm_up
+        self._timeout = timeout
+        self._session = None
+        self._semaphore = None
+        self._rate_limiter = rate_limiter
+
+    async def get_api_session(self):
+        if self._session is None:
+            logger.debug("AsyncAPIHandler: Nuova Sessione!")
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+            connector = aiohttp.TCPConnector(limit=self._concurrency)
+            timeout = aiohttp.ClientTimeout(total=self._timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            if self._warm_up:
+                try:
+                    async with self._session.get(self._url) as response:
+                        await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    # Sessione comunque utilizzabile: l'errore della richiesta vera passa per fetch_json
+                    logger.warning("AsyncAPIHandler: Riscaldamento della sessione su '%s' non riuscito: %r",
+                                   self._url, error)
+        return self._session
+
+    def get_rate_limiter(self):
+        return self._rate_limiter if self._rate_limiter is not None else get_rate_limiter()
+
+    @asynccontextmanager
+    async def request(self, rate_limiter):
+        """
+        Async counterpart of RateLimitController.request: waits for a token and a slot without
+        blocking the event loop.
+        """
+        start = perf_counter()
+        while True:
+            wait = rate_limiter.reserve_token()
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        while not rate_limiter.try_acquire_slot():
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+        get_metrics().observe("rate_limit_wait_seconds", perf_counter() - start)
+        try:
+            yield
+        finally:
+            rate_limiter.release_slot()
+
+    def build_url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self._url}{path}"
+
+    async def fetch_json(self, url, fields=None):
+        """
+        Fetch one URL, retrying throttled (403/429/503) or failed requests with exponential backoff and
+        jitter. Returns None for any other non-200 answer (e.g. a book that does not exist); raises
+        RateLimitExceeded once the retry cap is reached.
+        """
+        session = await self.get_api_session()
+        rate_limiter = self.get_rate_limiter()
+        metrics = get_metrics()
+        url = self.build_url(url)
+        endpoint = endpoint_name(url)
+        for attempt in range(rate_limiter.max_retries + 1):
+            status, body = "error", None
+            async with self._semaphore, self.request(rate_limiter):
+                try:
+                    start = perf_counter()
+                    async with session.get(url) as response:
+                        status = response.status
+                        if status == 200:
+                            body = await response.read()
+                    metrics.observe("http_request_seconds", perf_counter() - start, endpoint=endpoint)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    logger.warning("AsyncAPIHandler: Richiesta a '%s' non riuscita: %r", url, error)
+            metrics.increment("http_responses_total", endpoint=endpoint, status=status)
+            if status == 200:
+                rate_limiter.on_success()
+                return select_list_fields(loads(body), fields)
+            if status != "error" and status not in THROTTLE_STATUS_CODES:
+                return None
+            rate_limiter.on_throttle()
+            if attempt == rate_limiter.max_retries:
+                break
+            wait = rate_limiter.backoff_delay(attempt)
+            logger.warning("AsyncAPIHandler: Accesso API limitato. Tentativo %d/%d: attendere %.1f secondi.",
+                           attempt + 1, rate_limiter.max_retries, wait)
+            metrics.observe("retry_wait_seconds", wait, function="fetch_json")
+            await asyncio.sleep(wait)
+
+        raise RateLimitExceeded(f"Accesso API limitato dopo {rate_limiter.max_retries} tentativi per '{url}'.")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        await self.get_api_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+
+async def get_data(url, api_handler, fields=None):
+    """
+    Fetch data from the specified URL (or endpoint path) without blocking the event loop.
+    """
+    if not isinstance(api_handler, AsyncAPIHandler):
+        raise ValueError("AsyncAPIHandler: è necessario fornire un'istanza attiva di AsyncAPIHandler!")
+    return await api_handler.fetch_json(url, fields)
+
+
+async def get_province(region_id="05", api_handler=None):
+    return await get_data(province_path(region_id), api_handler)
+
+
+async def get_comuni(province_id="VR", api_handler=None):
+    return await get_data(comuni_path(province_id), api_handler)
+
+
+async def get_gradi(comune_id="Verona", api_handler=None):
+    return await get_data(gradi_path(comune_id), api_handler)
+
+
+async def get_scuole_grado(comune_id="Verona", grado_id=2, api_handler=None):
+    return await get_data(scuole_grado_path(comune_id, grado_id), api_handler)
+
+
+async def get_classi_scuola(scuola_id="VRTF03000V", api_handler=None):
+    return await get_data(classi_scuola_path(scuola_id), api_handler)
+
+
+async def get_libri_adottati(classe_id, scuola_id="VRTF03000V", api_handler=None):
+    return await get_data(libri_adottati_path(classe_id, scuola_id), api_handler)
+
+
+async def get_libro(libro_id, api_handler=None, fields=None):
+    return await get_data(libro_path(libro_id), api_handler, fields)
+
+
+async def get_scuola(scuola_id="VRTF03000V", comune_id="Verona", grado_id=2, api_handler=None):
+    scuole_grado_comune_dict = await get_scuole_grado(comune_id, grado_id, api_handler)
+    return [get_dict_from_id(scuole_grado_comune_dict or [], scuola_id, "COSCUO")]
+
+
+async def gather_data(source_function, params_list, api_handler):
+    """
+    Run source_function concurrently for every parameter dict and return the results in input order.
+    Failed requests are returned as their exception instead of aborting the whole batch.
+    """
+    tasks = [source_function(**params, api_handler=api_handler) for params in params_list]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def get_libri(libro_ids, api_handler):
+    """
+    Fetch the lookup payload of every ISBN concurrently; returns a dict ISBN -> payload, where a book that
+    does not exist maps to None and one still throttled after every retry to its RateLimitExceeded.
+    """
+    results = await gather_data(get_libro, [{"libro_id": libro_id} for libro_id in libro_ids], api_handler)
+    return dict(zip(libro_ids, results))
+
+
+def fetch_libri(libro_ids, url=API_BASE_URL, concurrency=100, rate_limiter=None):
+    """
+    Blocking entry point: fetch many book lookups from a single thread through the async engine.
+    """
+    async def run():
+        async with AsyncAPIHandler(url, concurrency, rate_limiter=rate_limiter) as api_handler:
+            return await get_libri(list(libro_ids), api_handler)
+
+    return asyncio.run(run())
+
+
+def main():
+    libri_dict = fetch_libri(["9788823365957"], concurrency=10)
+    print(libri_dict)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+from threading import RLock
+
+
+def _invalidating(method_name):
+    method = getattr(list, method_name)
+
+    def wrapper(self, *args, **kwargs):
+        self._clear_indexes()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method_name
+    return wrapper
+
+
+class IndexedList(list):
+    """
+    List of API records with O(1) lookups by key. A key is a field name ("COSCUO") or a tuple of
+    field names (("CLASSE", "SEZION")); the index of a key is built on its first lookup and maps each
+    value to the first record holding it, as a linear scan would. `keys` declares the keys to index
+    up front; any other key is indexed on demand. Being a list, it is a drop-in replacement for the
+    plain lists returned by the endpoint helpers.
+    """
+
+    def __init__(self, items=(), keys=()):
+        super().__init__(items)
+        self._keys = tuple(keys)
+        self._indexes = {}
+        self._index_lock = RLock()
+        for key in self._keys:
+            self.index_for(key)
+
+    @staticmethod
+    def key_value(item, key):
+        if isinstance(key, tuple):
+            return tuple(item.get(field) for field in key)
+        return item.get(key)
+
+    def index_for(self, key):
+        with self._index_lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = {}
+                for item in self:
+                    if isinstance(item, dict):
+                        try:
+                            index.setdefault(self.key_value(item, key), item)
+                        except TypeError:  # valori non indicizzabili, es. liste di autori
+                            continue
+                self._indexes[key] = index
+            return index
+
+    def find(self, key, value):
+        """
+        First record whose `key` equals `value` (a tuple of values for a composite key), or None.
+        """
+        if isinstance(key, tuple) and not isinstance(value, tuple):
+            value = tuple(value)
+        try:
+            return self.index_for(key).get(value)
+        except TypeError:
+            return next((item for item in self if isinstance(item, dict) and self.key_value(item, key) == value),
+                        None)
+
+    def match(self, search_values):
+        """
+        First record matching every field of the `search_values` dict, or None.
+        """
+        fields = tuple(search_values)
+        if len(fields) == 1:
+            return self.find(fields[0], search_values[fields[0]])
+        return self.find(fields, tuple(search_values.values()))
+
+    def ids(self, key="ID"):
+        return [item[key] for item in self if isinstance(item, dict) and key in item]
+
+    def _clear_indexes(self):
+        with self._index_lock:
+            self._indexes = {}
+
+    for _method_name in ("append", "extend", "insert", "remove", "pop", "clear", "sort", "reverse",
+                         "__setitem__", "__delitem__", "__iadd__", "__imul__"):
+        locals()[_method_name] = _invalidating(_method_name)
+    del _method_name
+
+    def __reduce_ex__(self, protocol):
+        return self.__class__, (list(self), self._keys)
+
+
+def indexed(list_dict, keys=()):
+    """
+    Wrap an endpoint result in an IndexedList, leaving failed (None) results untouched.
+    """
+    if list_dict is None or isinstance(list_dict, IndexedList):
+        return list_dict
+    return IndexedList(list_dict, keys)
@@ -0,0 +1,37 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # dipendenza opzionale, si ripiega sul modulo json della libreria standard
+    orjson = None
+
+
+def loads(data):
+    """
+    Decode a JSON document from bytes or str, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def select_fields(document, fields):
+    """
+    Keep only the given fields of a decoded document, preserving its nesting.
+    `fields` maps each key to None (keep the value as is) or to the nested fields to keep below it;
+    missing keys are left out, so lookups on the result behave as on the full document.
+    """
+    if not isinstance(document, dict):
+        return document
+    selected = {}
+    for key, nested_fields in fields.items():
+        if key in document:
+            value = document[key]
+            selected[key] = value if nested_fields is None else select_fields(value, nested_fields)
+    return selected
+
+
+def select_list_fields(list_dict, fields):
+    if fields is None or not isinstance(list_dict, list):
+        return list_dict
+    return [select_fields(item, fields) for item in list_dict]
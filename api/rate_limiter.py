@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from random import uniform
+from threading import RLock, Condition
+from time import monotonic, sleep
+from utils.log_utils import get_logger
+from utils.metrics import get_metrics
+
+logger = get_logger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimitController:
+    """
+    Shared throttle for every request sent to the API.
+    A token bucket caps the request rate and an AIMD limit caps the requests in flight:
+    both grow additively while requests succeed and are halved when the server throttles.
+    Retries wait an exponential backoff with full jitter, up to `max_retries` attempts.
+    """
+
+    def __init__(self, rate=10.0, max_rate=50.0, min_rate=0.5, concurrency=15, max_concurrency=30,
+                 min_concurrency=1, base_delay=1.0, max_delay=60.0, max_retries=8, decrease_factor=0.5):
+        self._lock = RLock()
+        self._slots = Condition(self._lock)
+        self._rate = rate
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._tokens = rate
+        self._last_refill = monotonic()
+        self._concurrency = concurrency
+        self._max_concurrency = max_concurrency
+        self._min_concurrency = min_concurrency
+        self._in_flight = 0
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._max_retries = max_retries
+        self._decrease_factor = decrease_factor
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._stats = {"requests": 0, "throttled": 0, "waited": 0.0}
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self._rate, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def reserve_token(self):
+        """
+        Non-blocking half of acquire_token, for callers that must not sleep (e.g. an event loop):
+        takes a token and returns 0, or returns the seconds to wait before trying again.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            wait = (1 - self._tokens) / self._rate
+            self._stats["waited"] += wait
+            return wait
+
+    def acquire_token(self):
+        while True:
+            wait = self.reserve_token()
+            if not wait:
+                return
+            sleep(wait)
+
+    def try_acquire_slot(self):
+        with self._slots:
+            if self._in_flight >= self._concurrency:
+                return False
+            self._in_flight += 1
+            self._stats["requests"] += 1
+            return True
+
+    def acquire_slot(self):
+        with self._slots:
+            while not self.try_acquire_slot():
+                self._slots.wait()
+
+    def release_slot(self):
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify()
+
+    @contextmanager
+    def request(self):
+        start = monotonic()
+        self.acquire_token()
+        self.acquire_slot()
+        get_metrics().observe("rate_limit_wait_seconds", monotonic() - start)
+        try:
+            yield
+        finally:
+            self.release_slot()
+
+    def on_success(self):
+        """
+        Additive increase: after a full window of successful requests, allow one more request
+        in flight and half a request per second more.
+        """
+        with self._slots:
+            self._successes += 1
+            if self._successes >= self._concurrency:
+                self._successes = 0
+                self._concurrency = min(self._max_concurrency, self._concurrency + 1)
+                self._rate = min(self._max_rate, self._rate + 0.5)
+                self._slots.notify()
+
+    def on_throttle(self):
+        """
+        Multiplicative decrease, applied at most once per base_delay so that the throttled
+        responses of a single burst do not collapse the limits to the minimum.
+        """
+        with self._lock:
+            self._stats["throttled"] += 1
+            self._successes = 0
+            now = monotonic()
+            if now - self._last_decrease < self._base_delay:
+                return
+            self._last_decrease = now
+            self._concurrency = max(self._min_concurrency, int(self._concurrency * self._decrease_factor))
+            self._rate = max(self._min_rate, self._rate * self._decrease_factor)
+            self._tokens = min(self._tokens, self._rate)
+            logger.warning("RateLimitController: Limitazione rilevata, nuova soglia %d richieste contemporanee "
+                           "a %.1f richieste/s", self._concurrency, self._rate)
+
+    def backoff_delay(self, attempt):
+        return uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+
+    @property
+    def max_retries(self):
+        return self._max_retries
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, concurrency=self._concurrency, rate=self._rate)
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from os import environ
+from threading import RLock, Event
+from time import monotonic
+from utils.log_utils import get_logger
+from utils.metrics import get_metrics
+
+logger = get_logger(__name__)
+
+
+class ReferenceCache:
+    """
+    In-process cache for the reference endpoints (province, comuni, gradi, school listings), whose answers
+    do not change during a run. Entries expire `ttl` seconds after being stored and the least recently used
+    ones are evicted beyond `max_entries`. Concurrent misses on the same key are collapsed into a single
+    load: the other threads wait for it instead of issuing the same request. Cached values are shared
+    between threads and must be treated as read-only.
+    Setting ADOZIONI_REFERENCE_CACHE=0 disables it.
+    """
+
+    def __init__(self, max_entries=4096, ttl=24 * 3600, enabled=True):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._enabled = enabled and environ.get("ADOZIONI_REFERENCE_CACHE", "1") != "0"
+        self._lock = RLock()
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._stats = {"hits": 0, "misses": 0, "evicted": 0, "expired": 0}
+        self._metrics = get_metrics()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def _count(self, name, key):
+        self._stats[name] += 1
+        self._metrics.increment(f"reference_cache_{name}_total", kind=key[0])
+
+    def get(self, key):
+        """
+        Cached value for `key` (a tuple whose first item is the endpoint kind), or None.
+        """
+        if not self._enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                self._count("expired", key)
+                return None
+            self._entries.move_to_end(key)
+            self._count("hits", key)
+            return value
+
+    def put(self, key, value):
+        if not self._enabled or value is None:
+            return
+        with self._lock:
+            self._entries[key] = (value, monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._count("evicted", evicted_key)
+
+    def get_or_load(self, key, loader):
+        """
+        Return the cached value for `key`, calling `loader()` on a miss. None (a throttled or failed answer)
+        is returned but not stored, so the next call retries.
+        """
+        if not self._enabled:
+            return loader()
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            with self._lock:
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = Event()
+                    self._count("misses", key)
+                    break
+            loading.wait()  # Un altro thread sta già scaricando la stessa risorsa: si riusa il suo risultato
+        try:
+            value = loader()
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def invalidate(self, kind=None):
+        """
+        Drop every entry of one endpoint kind, or all of them.
+        """
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == kind]:
+                del self._entries[key]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
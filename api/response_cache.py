@@ -0,0 +1,155 @@
+import sqlite3
+from os import makedirs, environ
+from os.path import join, dirname
+from threading import RLock
+from time import time
+from urllib.parse import urlsplit
+
+
+def ttl_rules():
+    """
+    Per-endpoint time to live, in seconds, matched by path prefix. Unlisted endpoints are not cached.
+    """
+    day = 24 * 3600
+    return [("/v1/regioni", 30 * day),
+            ("/v1/province", 30 * day),
+            ("/v1/comuni", 30 * day),
+            ("/v1/scuole", 7 * day),
+            ("/v1/classi", 7 * day),
+            ("/v1/lookup", 3 * day)]
+
+
+class ResponseCache:
+    """
+    Persistent HTTP response cache keyed by URL, stored in a sqlite file.
+    Expired entries are kept for conditional revalidation (ETag / Last-Modified) and the
+    least recently used ones are evicted once the stored bodies exceed `max_size` bytes. The access time
+    used for eviction is rewritten only when older than `access_resolution` seconds, so most hits are
+    plain reads.
+    """
+
+    def __init__(self, filename=None, max_size=512 * 1024 * 1024, rules=None, enabled=True, access_resolution=300):
+        self._filename = filename or join(dirname(__file__), "../data", "http_cache.db")
+        self._max_size = max_size
+        self._access_resolution = access_resolution
+        self._rules = rules if rules is not None else ttl_rules()
+        self._enabled = enabled and environ.get("ADOZIONI_HTTP_CACHE", "1") != "0"
+        self._lock = RLock()
+        self._connection = None
+        self._total_size = None
+
+    def get_connection(self):
+        with self._lock:
+            if self._connection is None:
+                makedirs(dirname(self._filename), exist_ok=True)
+                self._connection = sqlite3.connect(self._filename, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode = WAL;")
+                self._connection.execute("CREATE TABLE IF NOT EXISTS risposte (URL TEXT PRIMARY KEY, BODY BLOB, "
+                                         "ETAG TEXT, LAST_MODIFIED TEXT, EXPIRES_AT REAL, LAST_ACCESS REAL, "
+                                         "SIZE INTEGER)")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS risposte_last_access ON risposte (LAST_ACCESS)")
+                self._total_size = self._connection.execute(
+                    "SELECT COALESCE(SUM(SIZE), 0) FROM risposte").fetchone()[0]
+            return self._connection
+
+    def get_ttl(self, url):
+        path = urlsplit(url).path
+        for prefix, ttl in self._rules:
+            if path.startswith(prefix):
+                return ttl
+        return 0
+
+    def is_cacheable(self, url):
+        return self._enabled and self.get_ttl(url) > 0
+
+    def lookup(self, url):
+        """
+        Return the stored entry for url as a dict with a `fresh` flag, or None.
+        """
+        if not self.is_cacheable(url):
+            return None
+        with self._lock:
+            connection = self.get_connection()
+            row = connection.execute("SELECT BODY, ETAG, LAST_MODIFIED, EXPIRES_AT, LAST_ACCESS FROM risposte "
+                                     "WHERE URL = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            now = time()
+            if now - row[4] > self._access_resolution:
+                connection.execute("UPDATE risposte SET LAST_ACCESS = ? WHERE URL = ?", (now, url))
+                connection.commit()
+        return {"body": row[0], "etag": row[1], "last_modified": row[2], "fresh": row[3] > now}
+
+    def revalidation_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url, body, etag=None, last_modified=None):
+        if not self.is_cacheable(url):
+            return
+        now = time()
+        with self._lock:
+            connection = self.get_connection()
+            previous = connection.execute("SELECT SIZE FROM risposte WHERE URL = ?", (url,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO risposte VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (url, body, etag, last_modified, now + self.get_ttl(url), now, len(body)))
+            self._total_size += len(body) - (previous[0] if previous else 0)
+            self.evict()
+            connection.commit()
+
+    def refresh(self, url):
+        """
+        Extend the lifetime of an entry after the server confirmed it is still valid (304).
+        """
+        if not self.is_cacheable(url):
+            return
+        now = time()
+        with self._lock:
+            connection = self.get_connection()
+            connection.execute("UPDATE risposte SET EXPIRES_AT = ?, LAST_ACCESS = ? WHERE URL = ?",
+                               (now + self.get_ttl(url), now, url))
+            connection.commit()
+
+    def evict(self):
+        with self._lock:
+            connection = self.get_connection()
+            while self._total_size > self._max_size:
+                rows = connection.execute("SELECT URL, SIZE FROM risposte ORDER BY LAST_ACCESS LIMIT 100").fetchall()
+                if not rows:
+                    self._total_size = 0
+                    break
+                for url, size in rows:
+                    if self._total_size <= self._max_size:
+                        break
+                    connection.execute("DELETE FROM risposte WHERE URL = ?", (url,))
+                    self._total_size -= size
+
+    def clear(self):
+        with self._lock:
+            connection = self.get_connection()
+            connection.execute("DELETE FROM risposte")
+            connection.commit()
+            self._total_size = 0
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        self._enabled = bool(value)
+
+    @property
+    def total_size(self):
+        return self._total_size
@@ -0,0 +1,115 @@
+"""
+End-to-end throughput of main() against the local stub API, at several scales and worker counts.
+Every trial runs in a fresh interpreter with an empty database and the HTTP cache disabled, so peak RSS
+and timings are not inherited from earlier trials; the stub runs in this process.
+
+    python -m benchmarks.bench_pipeline [--classi 20 100] [--workers 4 15] [--latency 0.02] [--throttle 0.0]
+"""
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser, SUPPRESS
+from contextlib import redirect_stdout
+from io import StringIO
+from os import environ
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from benchmarks.stub_server import StubAPI, StubConfig
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # non disponibile su Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_trial(url, workers, rate=None):
+    """
+    Body of one trial, executed in the child interpreter: returns the measurements as a dict.
+    """
+    from api.adozioni_amazon_api import configure_session_pool, configure_response_cache, configure_rate_limiter
+    from utils.metrics import get_metrics
+    import main
+
+    configure_session_pool(url=url)
+    configure_response_cache(enabled=False)
+    if rate is not None:
+        configure_rate_limiter(rate=rate, max_rate=rate, concurrency=workers, max_concurrency=workers)
+    metrics = get_metrics()
+    metrics.reset()
+
+    start = perf_counter()
+    with redirect_stdout(StringIO()):
+        main.main(workers)
+    elapsed = perf_counter() - start
+
+    latency = metrics.get_histogram("http_request_seconds")
+    return {"seconds": elapsed,
+            "requests": metrics.get_counter("http_responses_total"),
+            "rows": metrics.get_counter("db_rows_total"),
+            "p50": latency.quantile(0.5) if latency is not None else None,
+            "p99": latency.quantile(0.99) if latency is not None else None,
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def spawn_trial(url, workers, rate=None):
+    with TemporaryDirectory() as directory:
+        env = dict(environ, ADOZIONI_DB_PATH=join(directory, "library.db"), ADOZIONI_HTTP_CACHE="0",
+                   ADOZIONI_LOG_LEVEL="ERROR")
+        command = [sys.executable, "-m", "benchmarks.bench_pipeline", "--trial", url, "--workers", str(workers)]
+        if rate is not None:
+            command += ["--rate", str(rate)]
+        completed = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:8.1f}" if seconds is not None else "       -"
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Benchmark della pipeline completa contro l'API simulata.")
+    parser.add_argument("--classi", type=int, nargs="+", default=[20, 100], help="classi della scuola (scale)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[4, 15], help="worker da provare")
+    parser.add_argument("--libri", type=int, default=8, help="libri adottati per classe")
+    parser.add_argument("--isbn", type=int, default=300, help="ISBN distinti in totale")
+    parser.add_argument("--latency", type=float, default=0.02, help="latenza del server simulato, in secondi")
+    parser.add_argument("--throttle", type=float, default=0.0, help="quota di risposte 429 casuali")
+    parser.add_argument("--max-rate", type=float, help="richieste al secondo oltre le quali il server risponde 429")
+    parser.add_argument("--rate", type=float, help="limite fisso di richieste al secondo del client "
+                                                   "(predefinito: controllo adattivo)")
+    parser.add_argument("--trial", metavar="URL", help=SUPPRESS)  # Esecuzione di una singola prova nel figlio
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    if arguments.trial:
+        print(json.dumps(run_trial(arguments.trial, arguments.workers[0], arguments.rate)))
+        return
+
+    print(f"{'classi':>7} {'worker':>6} {'richieste':>9} {'righe':>7} {'secondi':>8} {'req/s':>8} "
+          f"{'righe/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'429':>5} {'RSS MB':>7}")
+    for classi in arguments.classi:
+        config = StubConfig(classi, arguments.libri, arguments.isbn, latency=arguments.latency,
+                            throttle_probability=arguments.throttle, max_rate=arguments.max_rate)
+        for workers in arguments.workers:
+            stub_api = StubAPI(config).start()
+            try:
+                result = spawn_trial(stub_api.url, workers, arguments.rate)
+            finally:
+                stub_api.close()
+            stub_stats = stub_api.get_stats()
+            seconds = result["seconds"]
+            print(f"{classi:>7} {workers:>6} {result['requests']:>9} {result['rows']:>7} {seconds:>8.2f} "
+                  f"{result['requests'] / seconds:>8.1f} {result['rows'] / seconds:>8.1f} "
+                  f"{format_ms(result['p50'])} {format_ms(result['p99'])} {stub_stats['throttled']:>5} "
+                  f"{result['peak_rss_mb'] or 0:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
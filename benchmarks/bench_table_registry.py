@@ -0,0 +1,116 @@
+"""
+Per-row overhead of preparing and writing `adozioni` records, before and after the compiled table registry.
+The "before" path reproduces the original process_dict: it rebuilds the table models for every record and
+runs a SELECT followed by a formatted single-row UPDATE or INSERT.
+
+    python -m benchmarks.bench_table_registry [rows]
+"""
+import sqlite3
+from contextlib import redirect_stdout
+from io import StringIO
+from sys import argv
+from time import perf_counter
+from model.library import DatabaseHandler, tables_model, table_adozioni_model, create_tables, upsert_rows
+from control.db_api_control import get_table_registry, process_dict
+
+
+class MemoryDatabaseHandler(DatabaseHandler):
+    def __init__(self):
+        super().__init__(pooled=False)
+
+    def get_connection(self):
+        conn = sqlite3.connect(":memory:")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+def synthetic_adozioni(rows):
+    return [{"ISBN": f"97888{index:08d}", "CLID": 559000 + index % 40, "COSCUO": "VRTF03000V",
+             "DESC_DISCIPLINA": "CHIMICA", "NUOVA_ADOZIONE": "No", "CONSIGLIATO": "No", "DA_ACQUISTARE": "Si"}
+            for index in range(rows)]
+
+
+def legacy_prepare_dict(source_dict):
+    table_keys = [col[0] for col in table_adozioni_model()["columns"]]
+    prepare_dict = dict(zip(table_keys, [source_dict.get(column, None) for column in table_keys]))
+    expected_keys = [col[0] for col in table_adozioni_model()["columns"]]
+    return prepare_dict if all(key in prepare_dict for key in expected_keys) else None
+
+
+def legacy_process_dict(table_name, source_dict, connection):
+    prepare_dict = legacy_prepare_dict(source_dict)
+    if prepare_dict is None:
+        return
+    tables_model_structure = tables_model()
+    columns = [col[0] for col in tables_model_structure[table_name]["columns"]]
+    values = [prepare_dict.get(column, None) for column in columns]
+    pk_name = tables_model_structure[table_name]["pk"][0]
+    pk_value = prepare_dict[pk_name]
+    existing_row = connection.execute(f"SELECT * FROM {table_name} WHERE {pk_name} = ?", (pk_value,)).fetchone()
+    if existing_row:
+        existing_data = dict(existing_row)
+        if [existing_data[column] for column in columns[1:]] != values[1:]:
+            set_clause = ", ".join([f"{column} = ?" for column in columns[1:]])
+            connection.execute(f"UPDATE {table_name} SET {set_clause} WHERE {pk_name} = ?", (*values[1:], pk_value))
+    else:
+        placeholders = ", ".join(["?" for _ in values])
+        connection.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", values)
+
+
+def new_database_handler():
+    database_handler = MemoryDatabaseHandler()
+    create_tables(tables_model(), database_handler)
+    connection = database_handler.get_db_connection()
+    connection.execute("PRAGMA foreign_keys = OFF;")
+    return database_handler
+
+
+def bench_legacy_prepare(source_dict_list):
+    start = perf_counter()
+    for source_dict in source_dict_list:
+        legacy_prepare_dict(source_dict)
+    return perf_counter() - start
+
+
+def bench_compiled_prepare(source_dict_list):
+    get_table_registry()
+    start = perf_counter()
+    for source_dict in source_dict_list:
+        process_dict("adozioni", None, source_dict)
+    return perf_counter() - start
+
+
+def bench_legacy(source_dict_list):
+    database_handler = new_database_handler()
+    connection = database_handler.get_db_connection()
+    start = perf_counter()
+    for source_dict in source_dict_list:
+        legacy_process_dict("adozioni", source_dict, connection)
+    connection.commit()
+    return perf_counter() - start
+
+
+def bench_compiled(source_dict_list):
+    database_handler = new_database_handler()
+    get_table_registry()
+    start = perf_counter()
+    rows = [process_dict("adozioni", None, source_dict) for source_dict in source_dict_list]
+    upsert_rows("adozioni", rows, database_handler)
+    database_handler.get_db_connection().commit()
+    return perf_counter() - start
+
+
+def main():
+    rows = int(argv[1]) if len(argv) > 1 else 20000
+    source_dict_list = synthetic_adozioni(rows)
+    with redirect_stdout(StringIO()):
+        results = [("preparazione, prima", bench_legacy_prepare(source_dict_list)),
+                   ("preparazione, dopo", bench_compiled_prepare(source_dict_list)),
+                   ("preparazione + scrittura, prima", bench_legacy(source_dict_list)),
+                   ("preparazione + scrittura, dopo", bench_compiled(source_dict_list))]
+    for label, elapsed in results:
+        print(f"{label:<34} {elapsed:8.3f} s  {elapsed / rows * 1e6:8.2f} µs/riga")
+
+
+if __name__ == '__main__':
+    main()
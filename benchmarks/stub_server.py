@@ -0,0 +1,238 @@
+"""
+Local stand-in for the adozionilibriscolastici API, serving synthetic payloads shaped like the examples
+in the docstrings of api/adozioni_amazon_api.py, with configurable latency and throttling.
+
+    python -m benchmarks.stub_server [--port 8765] [--classi 40] [--libri 8] [--latency 0.02] [--throttle 0.0]
+"""
+import json
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Thread, RLock
+from time import sleep, monotonic
+from urllib.parse import urlsplit, parse_qs
+from zlib import crc32
+
+SCUOLA_ID = "VRTF03000V"
+COMUNE_ID = "Verona"
+GRADO_ID = 2
+
+
+class StubConfig:
+    def __init__(self, classi=40, libri_per_classe=8, isbn_pool=300, scuole=5, latency=0.02, jitter=0.005,
+                 throttle_probability=0.0, max_rate=None, seed=1):
+        self.classi = classi
+        self.libri_per_classe = libri_per_classe
+        self.isbn_pool = isbn_pool
+        self.scuole = scuole
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_probability = throttle_probability
+        self.max_rate = max_rate
+        self.seed = seed
+
+
+def isbn(index):
+    return f"97888{index:08d}"
+
+
+def scuola_payload(scuola_id, comune_id=COMUNE_ID, grado_id=GRADO_ID):
+    return {"CAPSCU": "37121", "COSCUO": scuola_id, "DESIS": "SCUOLA SECONDARIA DI II GRADO",
+            "INDSCU": "VIA DON G. BERTONI N. 3/B", "LOCSCU": comune_id, "NOMSCU": f'"ISTITUTO {scuola_id}"',
+            "FRZSCU": None, "TIPO_SCUOLA": "ISTITUTO TECNICO", "GRADO": grado_id}
+
+
+def classe_payload(classe_id, scuola_id, index):
+    return {"CLASSE": str(index % 5 + 1), "CLID": classe_id, "COSCUO": scuola_id,
+            "DESCOMB": "INFORMATICA E TELECOMUNICAZIONI - BIENNIO COMUNE",
+            "DESIS": "SCUOLA SECONDARIA DI II GRADO", "SEZION": f"A{index // 5}", "CODSPR": "IT13",
+            "CODSPC": None, "TIPSCU": "NO", "ABTEST_NEWIF": 1, "ABTEST_ENABLED": 1, "DES_COMB_CNT": 2}
+
+
+def adozione_payload(classe_id, scuola_id, libro_id, order):
+    return {"AUTORI": "CORDIOLI DORIANO  ", "CLASSE": "1", "CLID": classe_id, "CONSIGLIATO": "No",
+            "COSCUO": scuola_id, "DA_ACQUISTARE": "Si", "DESC_DISCIPLINA": "CHIMICA", "EDITORE": "TRAMONTANA",
+            "ISBN": libro_id, "NUOVA_ADOZIONE": "No", "ORD": order, "SEZIONE": "AI",
+            "SOTTOTITOLO": "VOLUME UNICO PER IL BIENNIO", "TITOLO": "CHIMICA PRATICA - LIBRO MISTO CON LIBRO DIGITALE",
+            "SHOW_USED": 0, "SHOW_PRIME_NOW_EAN": 0, "SHOW_PRIME_NOW_COSCUO": 0, "DIGITALE": 0}
+
+
+def libro_payload(libro_id):
+    image = f"https://m.media-amazon.com/images/I/{libro_id}"
+    return {"ASIN": libro_id[3:],
+            "DetailPageURL": f"https://www.amazon.it/dp/{libro_id[3:]}?tag=adozilibris0f-21&linkCode=ogi&th=1&psc=1",
+            "Images": {"Primary": {"Small": {}, "Medium": {}, "Large": {}}},
+            "ItemInfo": {"ByLineInfo": {"Contributors": [{"Locale": "it_IT", "Name": "Cordioli, Doriano",
+                                                          "Role": "Autore"}]},
+                         "Classifications": {"Binding": {"DisplayValue": "Copertina flessibile"}},
+                         "ContentInfo": {"PagesCount": {"DisplayValue": 976}},
+                         "ExternalIds": {"ISBNs": {"DisplayValues": [libro_id[3:]]}}},
+            "Offers": {"Summaries": [None, {"Condition": {"Value": "Used"},
+                                            "LowestPrice": {"Amount": 19.9, "Currency": "EUR"}}],
+                       "Offer": {"OfferListing": {"Availability": "Disponibilità immediata",
+                                                  "Price": {"Amount": "3690", "Currency": "EUR",
+                                                            "FormattedPrice": "36,90\xa0€"}}},
+                       "TotalOffers": 1},
+            "SmallImage": {"URL": f"{image}._SL75_.jpg", "Height": {"_": 75}, "Width": {"_": 55}},
+            "MediumImage": {"URL": f"{image}._SL160_.jpg", "Height": {"_": 160}, "Width": {"_": 117}},
+            "LargeImage": {"URL": f"{image}._SL500_.jpg", "Height": {"_": 500}, "Width": {"_": 368}},
+            "ItemAttributes": {"EAN": libro_id, "ReleaseDate": "2021-09-15T00:00:01Z",
+                               "PublicationDate": "2021-09-15T00:00:01Z",
+                               "Title": f"Chimica pratica {libro_id}. Vol. unico. "
+                                        "Per il biennio delle Scuole superiori",
+                               "Publisher": "Tramontana", "Author": ["Cordioli, Doriano"],
+                               "ListPrice": {"Amount": "4190", "FormattedPrice": "41,90\xa0€"}}}
+
+
+class StubAPI:
+    """
+    Threaded HTTP server answering the endpoints used by main() and crawl(): `scuole` schools with `classi`
+    classes each (CLIDs derived from the school code), each class adopting `libri_per_classe` books drawn
+    from a pool of `isbn_pool` ISBNs.
+    Every response waits `latency` ± `jitter` seconds; requests beyond `max_rate` per second, and a random
+    `throttle_probability` share of the others, are answered with 429.
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config if config is not None else StubConfig()
+        self._random = Random(self.config.seed)
+        self._lock = RLock()
+        self._window = (0, 0)
+        self._stats = {"requests": 0, "throttled": 0, "bytes": 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._server.serve_forever, name="StubAPI", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def count_bytes(self, size):
+        with self._lock:
+            self._stats["bytes"] += size
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {"requests": 0, "throttled": 0, "bytes": 0}
+
+    def is_throttled(self):
+        config = self.config
+        with self._lock:
+            self._stats["requests"] += 1
+            second = int(monotonic())
+            window_second, window_count = self._window
+            window_count = window_count + 1 if window_second == second else 1
+            self._window = (second, window_count)
+            throttled = ((config.max_rate is not None and window_count > config.max_rate)
+                         or self._random.random() < config.throttle_probability)
+            if throttled:
+                self._stats["throttled"] += 1
+            return throttled
+
+    def delay(self):
+        with self._lock:
+            jitter = self._random.uniform(-self.config.jitter, self.config.jitter)
+        return max(0.0, self.config.latency + jitter)
+
+    def classe_ids(self, scuola_id):
+        # CLID distinti per ogni scuola, così le classi di scuole diverse non si sovrascrivono nel database
+        stride = 10 ** len(str(self.config.classi))
+        return [crc32(scuola_id.encode("ascii")) * stride + index for index in range(self.config.classi)]
+
+    def payload(self, path, query):
+        config = self.config
+        segments = path.strip("/").split("/")
+        resource = segments[1] if len(segments) > 1 else ""
+        if resource == "scuole":
+            comune_id = query.get("locId", [COMUNE_ID])[0]
+            scuole = [SCUOLA_ID] + [f"VRTF0{index:04d}X" for index in range(1, config.scuole)]
+            return [scuola_payload(scuola_id, comune_id) for scuola_id in scuole]
+        if resource == "classi" and len(segments) > 2:
+            return [classe_payload(classe_id, segments[2], index)
+                    for index, classe_id in enumerate(self.classe_ids(segments[2]))]
+        if resource == "libri" and len(segments) > 3:
+            classe_id = int(segments[2])
+            return [adozione_payload(classe_id, segments[3], isbn((classe_id * 7 + order * 13) % config.isbn_pool),
+                                     order)
+                    for order in range(config.libri_per_classe)]
+        if resource == "lookup" and len(segments) > 2:
+            return [libro_payload(segments[2])]
+        if resource == "regioni":
+            return [{"ID": "VR", "VALUE": "Verona"}]
+        if resource == "province":
+            return [{"ID": COMUNE_ID, "VALUE": COMUNE_ID}]
+        if resource == "comuni":
+            return [{"ID": GRADO_ID, "VALUE": "SCUOLA SECONDARIA DI II GRADO"}]
+        return []
+
+    def _handler_class(self):
+        stub = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            wbufsize = 1 << 16  # Intestazioni e corpo partono con un'unica scrittura sul socket
+
+            def do_GET(self):
+                sleep(stub.delay())
+                if stub.is_throttled():
+                    self.respond(429, b"")
+                    return
+                parts = urlsplit(self.path)
+                body = json.dumps(stub.payload(parts.path, parse_qs(parts.query))).encode("utf-8")
+                stub.count_bytes(len(body))
+                self.respond(200, body)
+
+            def respond(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return StubHandler
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Server locale che simula l'API di adozionilibriscolastici.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--classi", type=int, default=40, help="classi della scuola")
+    parser.add_argument("--libri", type=int, default=8, help="libri adottati per classe")
+    parser.add_argument("--isbn", type=int, default=300, help="ISBN distinti in totale")
+    parser.add_argument("--latency", type=float, default=0.02, help="latenza di ogni risposta, in secondi")
+    parser.add_argument("--throttle", type=float, default=0.0, help="quota di risposte 429 casuali")
+    parser.add_argument("--max-rate", type=float, help="richieste al secondo oltre le quali si risponde 429")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    stub_config = StubConfig(arguments.classi, arguments.libri, arguments.isbn, latency=arguments.latency,
+                             throttle_probability=arguments.throttle, max_rate=arguments.max_rate)
+    stub_api = StubAPI(stub_config, port=arguments.port)
+    print(f"StubAPI in ascolto su {stub_api.url}")
+    try:
+        stub_api.serve_forever()
+    except KeyboardInterrupt:
+        stub_api.close()
@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+from threading import RLock
+from model.library import retrieve_checkpoint, clear_checkpoint, unit_key
+
+CHECKPOINT_UNITS = ("scuola", "classe", "libro")
+
+
+class CheckpointJournal:
+    """
+    Work units (schools, classes, ISBNs) completed by the current crawl, persisted in the `checkpoint` table.
+    A unit's journal row is queued after the data rows it covers, so the single writer commits it in the
+    same transaction or a later one: a journaled unit is always fully stored. When resuming, the units
+    journaled by the interrupted run are skipped and only the outstanding ones are fetched again.
+    """
+
+    def __init__(self, completed=None, resume=False):
+        self._lock = RLock()
+        self._completed = set(completed or ()) if resume else set()
+        self._resume = resume
+        self._stats = {"skipped": 0, "completed": 0}
+
+    def is_done(self, unit, *key_parts):
+        with self._lock:
+            done = self._resume and (unit, unit_key(*key_parts)) in self._completed
+            if done:
+                self._stats["skipped"] += 1
+            return done
+
+    def checkpoint_row(self, unit, *key_parts):
+        """
+        Record a completed unit and return the `checkpoint` row to persist after its data.
+        """
+        if unit not in CHECKPOINT_UNITS:
+            raise ValueError(f"CheckpointJournal: unità di lavoro sconosciuta '{unit}'")
+        key = unit_key(*key_parts)
+        with self._lock:
+            self._completed.add((unit, key))
+            self._stats["completed"] += 1
+        return {"UNIT": unit,
+                "UNIT_KEY": key,
+                "COMPLETED_AT": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+    @property
+    def resume(self):
+        return self._resume
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def load_checkpoint(resume=False, database_handler=None):
+    """
+    Journal for a new run: the units left by the previous run when resuming, an emptied journal otherwise.
+    """
+    if resume:
+        return CheckpointJournal(retrieve_checkpoint(database_handler), resume=True)
+    clear_checkpoint(database_handler)
+    return CheckpointJournal()
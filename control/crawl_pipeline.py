@@ -0,0 +1,120 @@
+from functools import partial
+from threading import RLock
+from utils.worker_pool import WorkerPool, get_worker_context
+from model.library import retrieve_classe_ids
+from api.adozioni_amazon_api import (get_regioni, get_province, get_comuni, get_gradi, get_scuole_grado,
+                                     get_classi_scuola, get_all_ids_from_dict, retry_session)
+from control.db_api_control import DatabaseAPIHandler, insert_data_from_api, worker_initializer, worker_finalizer
+from control.stream_pipeline import AdozioniStream
+
+
+class CrawlPipeline:
+    """
+    Concurrent walk of the regioni -> province -> comuni -> gradi -> scuole -> classi hierarchy.
+    Every node is a task of the discovery pool, so sibling nodes are fetched in parallel;
+    scuole and classi are written as soon as they are found and each class is handed
+    to the adoption stream while the upper levels are still being discovered.
+    """
+
+    def __init__(self, db_writer=None, libri_registry=None, sync_state=None, discovery_workers=8,
+                 adoption_workers=15, gradi_ids=None, checkpoint=None):
+        initializer = partial(worker_initializer, db_writer, libri_registry, sync_state, checkpoint)
+        self._db_writer = db_writer
+        self._libri_registry = libri_registry
+        self._sync_state = sync_state
+        self._checkpoint = checkpoint
+        self._discovery_pool = WorkerPool(discovery_workers, initializer=initializer, finalizer=worker_finalizer,
+                                          name="Discovery")
+        self._adozioni_stream = AdozioniStream(db_writer, libri_registry, sync_state, adoption_workers,
+                                               checkpoint=checkpoint)
+        self._gradi_ids = set(gradi_ids) if gradi_ids is not None else None
+        self._lock = RLock()
+        self._stats = {"province": 0, "comuni": 0, "gradi": 0, "scuole": 0, "classi": 0}
+
+    def get_db_api_handler(self):
+        db_api_handler = get_worker_context()
+        if db_api_handler is None:
+            db_api_handler = DatabaseAPIHandler(self._db_writer, self._libri_registry, self._sync_state,
+                                                self._checkpoint)
+        return db_api_handler
+
+    def _count(self, level, amount=1):
+        with self._lock:
+            self._stats[level] += amount
+
+    def _fetch(self, source_function, source_params):
+        source_params["api_handler"] = self.get_db_api_handler().get_api_handler()
+        return retry_session(source_function, source_params)
+
+    def crawl_regione(self, regione_id):
+        province_list = self._fetch(get_province, {"region_id": regione_id})
+        for provincia_id in get_all_ids_from_dict(province_list):
+            self._discovery_pool.submit(self.crawl_provincia, provincia_id)
+        return regione_id
+
+    def crawl_provincia(self, provincia_id):
+        self._count("province")
+        comuni_list = self._fetch(get_comuni, {"province_id": provincia_id})
+        for comune_id in get_all_ids_from_dict(comuni_list):
+            self._discovery_pool.submit(self.crawl_comune, comune_id)
+        return provincia_id
+
+    def crawl_comune(self, comune_id):
+        self._count("comuni")
+        gradi_list = self._fetch(get_gradi, {"comune_id": comune_id})
+        for grado_id in get_all_ids_from_dict(gradi_list):
+            if self._gradi_ids is None or grado_id in self._gradi_ids:
+                self._discovery_pool.submit(self.crawl_grado, comune_id, grado_id)
+        return comune_id
+
+    def crawl_grado(self, comune_id, grado_id):
+        self._count("gradi")
+        scuole_list = self._fetch(get_scuole_grado, {"comune_id": comune_id, "grado_id": grado_id})
+        scuole_list = [scuola for scuola in scuole_list if scuola]
+        if scuole_list:
+            source_param = {"comune_id": comune_id, "grado_id": grado_id}
+            insert_data_from_api("scuole", self.get_db_api_handler(), source_param, scuole_list)
+        for scuola_id in get_all_ids_from_dict(scuole_list, "COSCUO"):
+            self._discovery_pool.submit(self.crawl_scuola, scuola_id)
+        self._count("scuole", len(scuole_list))
+        return comune_id, grado_id
+
+    def crawl_scuola(self, scuola_id):
+        db_api_handler = self.get_db_api_handler()
+        if db_api_handler.get_checkpoint().is_done("scuola", scuola_id):
+            # Classi già salvate dall'esecuzione interrotta: restano da completare solo le loro adozioni
+            classe_ids = retrieve_classe_ids(scuola_id, db_api_handler.get_db_handler())
+        else:
+            classi_list = self._fetch(get_classi_scuola, {"scuola_id": scuola_id})
+            classi_list = [classe for classe in classi_list if classe]
+            if classi_list and insert_data_from_api("classi", db_api_handler, {"scuola_id": scuola_id}, classi_list):
+                db_api_handler.mark_done("scuola", scuola_id)
+            classe_ids = get_all_ids_from_dict(classi_list, "CLID")
+        for classe_id in classe_ids:
+            self._adozioni_stream.submit(classe_id, scuola_id)
+        self._count("classi", len(classe_ids))
+        return scuola_id
+
+    def run(self, regioni_ids=None, province_ids=None):
+        """
+        Crawl the given regions and/or provinces (all regions when neither is given) and return
+        the per-task results of the discovery and the per-item errors of the adoption stream.
+        """
+        if regioni_ids is None and province_ids is None:
+            regioni_ids = list(get_regioni().values())
+        self._discovery_pool.start()
+        self._adozioni_stream.start()
+        try:
+            for regione_id in regioni_ids or []:
+                self._discovery_pool.submit(self.crawl_regione, regione_id)
+            for provincia_id in province_ids or []:
+                self._discovery_pool.submit(self.crawl_provincia, provincia_id)
+            discovery_results = self._discovery_pool.join()
+        finally:
+            self._discovery_pool.shutdown()
+            adoption_errors = self._adozioni_stream.join()
+        return discovery_results, adoption_errors
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -1,17 +1,29 @@
+from functools import lru_cache
 from threading import get_ident, RLock, Semaphore
-from model.library import (DatabaseHandler, table_scuole_model, table_classi_model, table_libri_model,
-                           table_adozioni_model, tables_model, select_row, update_row, insert_row, retrieve_classe_ids)
+from utils.log_utils import get_logger, Truncated
+from utils.metrics import get_metrics
+from control.libri_registry import LibriRegistry
+from control.sync_state import SyncState
+from control.checkpoint import CheckpointJournal
+from model.library import DatabaseHandler, tables_model, table_columns, table_column_set, upsert_rows, select_row
 from api.adozioni_amazon_api import (APIHandler, get_scuola, get_classi_scuola, get_libro, get_libri_adottati,
-                                     fetch_data_from_source, retry_session)
+                                     retry_session)
+from api.rate_limiter import RateLimitExceeded
+
+logger = get_logger(__name__)
 
 
 class DatabaseAPIHandler:
-    def __init__(self):
+    def __init__(self, db_writer=None, libri_registry=None, sync_state=None, checkpoint=None):
         self._ident = get_ident()
         self._lock = RLock()
         self._semaphore = Semaphore()
         self._db_handler = DatabaseHandler()
         self._api_handler = APIHandler()
+        self._db_writer = db_writer
+        self._libri_registry = libri_registry if libri_registry is not None else LibriRegistry()
+        self._sync_state = sync_state if sync_state is not None else SyncState()
+        self._checkpoint = checkpoint if checkpoint is not None else CheckpointJournal()
 
     def acquire_semaphore(self):
         self._semaphore.acquire()
@@ -27,6 +39,39 @@ class DatabaseAPIHandler:
         with self._lock:
             return self._api_handler
 
+    def get_db_writer(self):
+        with self._lock:
+            return self._db_writer
+
+    def get_libri_registry(self):
+        with self._lock:
+            return self._libri_registry
+
+    def get_sync_state(self):
+        with self._lock:
+            return self._sync_state
+
+    def get_checkpoint(self):
+        with self._lock:
+            return self._checkpoint
+
+    def mark_done(self, unit, *key_parts):
+        """
+        Queue the journal row of a completed unit behind the data rows already written for it.
+        """
+        self.write_rows("checkpoint", [self.get_checkpoint().checkpoint_row(unit, *key_parts)])
+
+    def write_rows(self, table_name, rows):
+        """
+        Hand the prepared rows to the shared writer thread, or write and commit them locally without one.
+        """
+        if self._db_writer is not None:
+            self._db_writer.put_rows(table_name, rows)
+            return
+        with self._lock:
+            upsert_rows(table_name, rows, self._db_handler)
+            self._db_handler.commit_connection()
+
     def commit_connection(self):
         with self._lock:
             self._db_handler.commit_connection()
@@ -43,9 +88,9 @@ class DatabaseAPIHandler:
 def validate_database_api_handler(database_api_handler=None):
     if database_api_handler is None or not isinstance(database_api_handler, DatabaseAPIHandler):
         database_api_handler = DatabaseAPIHandler()
-        print(f"Creo una nuova istanza di DatabaseAPIHandler con identificatore {database_api_handler.ident}!")
+        logger.debug("Creo una nuova istanza di DatabaseAPIHandler con identificatore %d!", database_api_handler.ident)
     else:
-        print(f"Riutilizzo l'istanza di DatabaseAPIHandler con identificatore {database_api_handler.ident}!")
+        logger.debug("Riutilizzo l'istanza di DatabaseAPIHandler con identificatore %d!", database_api_handler.ident)
     return database_api_handler
 
 
@@ -68,7 +113,7 @@ def classi_control():
 
 
 def libro_control():
-    return {"source": get_libro,
+    return {"source": get_libro_fields,
             "source_params": {"libro_id": 9788823365957,  # None,
                               "api_handler": None},
             "prepare_dict": libro_dict_structure,
@@ -98,22 +143,22 @@ def prepare_dict_from_mapping(source_dict, api_keys, table_keys):
     return prepared_dict
 
 
+SCUOLA_API_KEYS = ("COSCUO", "DESIS", "TIPO_SCUOLA", "NOMSCU", "INDSCU", "CAPSCU", "LOCSCU")
+CLASSE_API_KEYS = ("CLID", "COSCUO", "ASCO", "CLASSE", "SEZION", "DESCOMB")
+
+
 def scuola_dict_structure(source_dict, source_params=None):
-    api_keys = ["COSCUO", "DESIS", "TIPO_SCUOLA", "NOMSCU", "INDSCU", "CAPSCU", "LOCSCU"]
-    table_info_model = table_scuole_model()
-    table_keys = [col[0] for col in table_info_model["columns"]]
+    table_keys = table_columns("scuole")
 
-    prepared_dict = prepare_dict_from_mapping(source_dict, api_keys, table_keys)
+    prepared_dict = prepare_dict_from_mapping(source_dict, SCUOLA_API_KEYS, table_keys)
 
     return prepared_dict
 
 
 def classe_dict_structure(source_dict, source_params=None):
-    api_keys = ["CLID", "COSCUO", "ASCO", "CLASSE", "SEZION", "DESCOMB"]
-    table_info_model = table_classi_model()
-    table_keys = [col[0] for col in table_info_model["columns"]]
+    table_keys = table_columns("classi")
 
-    prepared_dict = prepare_dict_from_mapping(source_dict, api_keys, table_keys)
+    prepared_dict = prepare_dict_from_mapping(source_dict, CLASSE_API_KEYS, table_keys)
 
     if "ASCO" not in source_dict:
         prepared_dict["ASCO"] = "2023/2024"
@@ -121,16 +166,37 @@ def classe_dict_structure(source_dict, source_params=None):
     return prepared_dict
 
 
+def libro_fields():
+    """
+    The only parts of a lookup document read by libro_dict_structure.
+    """
+    item_attributes = {column: None for column in table_columns("libri")}
+    return {"ItemAttributes": item_attributes,
+            "DetailPageURL": None,
+            "LargeImage": {"URL": None},
+            "Offers": {"Offer": {"OfferListing": {"Price": {"FormattedPrice": None}}}}}
+
+
+LIBRO_FIELDS = libro_fields()
+
+
+def get_libro_fields(libro_id, api_handler=None):
+    """
+    get_libro reduced to the fields of the `libri` table, so the rest of the document is dropped
+    right after decoding instead of being kept for the whole transformation.
+    """
+    return get_libro(libro_id, api_handler, fields=LIBRO_FIELDS)
+
+
 def libro_dict_structure(source_dict, source_params=None):
-    table_info_model = table_libri_model()
-    table_keys = [col[0] for col in table_info_model["columns"]]
+    table_keys = table_columns("libri")
 
     item_attributes = source_dict.get('ItemAttributes', {})
     detail_page_url = source_dict.get('DetailPageURL')
     large_image = source_dict.get('LargeImage', {}).get('URL')
     offers = (source_dict.get('Offers', {}).get('Offer', {}).get('OfferListing', {}).get('Price', {})
               .get('FormattedPrice'))
-    values = [item_attributes.get(column) if column in item_attributes else None for column in table_keys]
+    values = [item_attributes.get(column) for column in table_keys]
     values[0] = values[0] if values[0] else source_params.get('libro_id')
     values[2] = '; '.join(values[2]) if values[2] else None
     values[6] = detail_page_url if detail_page_url else None
@@ -142,72 +208,62 @@ def libro_dict_structure(source_dict, source_params=None):
 
 
 def adozione_dict_structure(source_dict, source_params=None):
-    table_info_model = table_adozioni_model()
-    table_keys = [col[0] for col in table_info_model["columns"]]
-    values = [source_dict.get(column, None) for column in table_keys]
+    table_keys = table_columns("adozioni")
+    values = list(map(source_dict.get, table_keys))
     for i in range(4, 7):
-        if values[i] not in ['Si', 'No']:
-            print(f"Cambio il valore '{values[i]}' per il constraint '{table_keys[i]}' "
-                  f"dell'adozione nella classe '{values[1]}' per il libro '{values[0]}'")
+        if values[i] not in ('Si', 'No'):
+            logger.debug("Cambio il valore '%s' per il constraint '%s' dell'adozione nella classe '%s' "
+                         "per il libro '%s'", values[i], table_keys[i], values[1], values[0])
             values[i] = None
     return dict(zip(table_keys, values))
 
 
+def check_dict_structure(table_name, source_dict):
+    return source_dict.keys() >= table_column_set(table_name)
+
+
 def check_scuola_dict_structure(source_dict):
-    table_info_model = table_scuole_model()
-    expected_keys = [col[0] for col in table_info_model["columns"]]
-    return all(key in source_dict for key in expected_keys)
+    return check_dict_structure("scuole", source_dict)
 
 
 def check_classe_dict_structure(source_dict):
-    table_info_model = table_classi_model()
-    expected_keys = [col[0] for col in table_info_model["columns"]]
-    return all(key in source_dict for key in expected_keys)
+    return check_dict_structure("classi", source_dict)
 
 
 def check_libro_dict_structure(source_dict):
-    table_info_model = table_libri_model()
-    expected_keys = [col[0] for col in table_info_model["columns"]]
-    return all(key in source_dict for key in expected_keys)
+    # Una ricerca limitata o senza ItemAttributes produce solo l'EAN: non è un libro valido
+    return check_dict_structure("libri", source_dict) and bool(source_dict.get("Title"))
 
 
 def check_adozione_dict_structure(source_dict):
-    table_info_model = table_adozioni_model()
-    expected_keys = [col[0] for col in table_info_model["columns"]]
-    return all(key in source_dict for key in expected_keys)
-
-
-def process_dict(table_name, source_params, source_dict, database_handler=None):
-    controllers = get_controllers()
-    prepare_dict_function = controllers[table_name]["prepare_dict"]
-    prepare_dict = prepare_dict_function(source_dict, source_params)
-    check_structure_function = controllers[table_name]["structure_check"]
-    dati = check_structure_function(prepare_dict)
-    # print(f"Dato trattato '{prepare_dict}' con esito: '{dati}'")
+    return check_dict_structure("adozioni", source_dict)
+
+
+@lru_cache(maxsize=None)
+def get_table_registry():
+    """
+    Per-table transform and validation functions, looked up once per process. Unlike get_controllers()
+    it holds no source parameters, so it is safe to share. The write side is compiled by
+    table_upsert_plan in the model.
+    """
+    return {table_name: {"prepare_dict": controller["prepare_dict"],
+                         "structure_check": controller["structure_check"]}
+            for table_name, controller in get_controllers().items()}
+
+
+def process_dict(table_name, source_params, source_dict):
+    """
+    Prepare an API record for its table; returns None when the resulting structure is not valid.
+    """
+    table_entry = get_table_registry()[table_name]
+    with get_metrics().timer("transform_seconds", table=table_name):
+        prepare_dict = table_entry["prepare_dict"](source_dict, source_params)
+        dati = table_entry["structure_check"](prepare_dict)
     if not dati:
-        print(f"Errore: la struttura del dizionario ottenuto dall'API non è corretta per la tabella '{table_name}'.")
-        return
-
-    tables_model_structure = tables_model()
-    columns = [col[0] for col in tables_model_structure[table_name]["columns"]]
-    values = [prepare_dict.get(column, None) for column in columns]
-
-    pk_name = tables_model_structure[table_name]["pk"][0]
-    pk_value = prepare_dict[pk_name]
-
-    existing_row = select_row(table_name, pk_name, pk_value, database_handler)
-
-    if existing_row:
-        existing_data = dict(existing_row)
-        existing_values = [existing_data[column] for column in columns[1:]]
-        if existing_values != values[1:]:
-            update_row(table_name, columns[1:], values[1:], pk_name, pk_value, database_handler)
-            print(f"I dati della tabella '{table_name}' -> '{pk_value}' sono aggiornati.")
-        else:
-            print(f"I dati della tabella '{table_name}' -> '{pk_value}' sono già aggiornati.")
-    else:
-        insert_row(table_name, columns, values, database_handler)
-        print(f"Nuova riga inserita nella tabella '{table_name}' -> '{pk_value}'.")
+        logger.warning("Errore: la struttura del dizionario ottenuto dall'API non è corretta per la tabella '%s': %s",
+                       table_name, Truncated(source_dict))
+        return None
+    return prepare_dict
 
 
 def insert_data_from_api(table_name, database_api_handler=None, source_param=None, source_dict_list=None):
@@ -221,63 +277,51 @@ def insert_data_from_api(table_name, database_api_handler=None, source_param=Non
         source_params.update({k: v for k, v in source_param.items() if v is not None})
 
     if None in source_params.values():
-        get_dynamic_parameter_value(table_name, database_api_handler, source_params)
+        logger.error("Errore: Parametri della sorgente non completamente specificati per la tabella '%s'.", table_name)
+        return []
 
     if not source_dict_list:
-        source_dict_list = fetch_data_from_source(source_function, source_params)
-
-    database_handler = database_api_handler.get_db_handler()
+        source_dict_list = retry_session(source_function, source_params)
 
+    rows = []
     for source_dict in source_dict_list:
-        process_dict(table_name, source_params, source_dict, database_handler)
-
-    database_api_handler.commit_connection()
-
-
-def get_dynamic_parameter_value(table_name, database_api_handler=None, source_param=None):
-    database_api_handler = validate_database_api_handler(database_api_handler)
-    database_handler = database_api_handler.get_db_handler()
-    if table_name == "adozioni":
-        classe_ids = retrieve_classe_ids(source_param["scuola_id"], database_handler)
-        print(f"Classi da recuperare: '{classe_ids}'")
-        for classe_id in classe_ids:
-            adozione_classe(classe_id, database_api_handler, source_param)
-    else:
-        print("Errore: Parametri della sorgente non completamente specificati.")
-        return
-
-
-def adozione_classe(classe_id, db_api_handler=None, source_param=None):
-    api_handler = db_api_handler.get_api_handler()
-    source_param_copy = source_param.copy()
-    source_param_copy["classe_id"] = classe_id
-    source_param_copy["api_handler"] = api_handler
-    source_dict_list = retry_session(get_libri_adottati, source_param_copy)
-
-    for adozione in source_dict_list:
-        book_ids = adozione.get('ISBN')
-        new_param = {"libro_id": book_ids, "api_handler": api_handler}
-
+        prepare_dict = process_dict(table_name, source_params, source_dict)
+        if prepare_dict is not None:
+            rows.append(prepare_dict)
+
+    database_api_handler.write_rows(table_name, rows)
+    return rows
+
+
+def libro_classe(libro_id, db_api_handler=None):
+    """
+    Return the prepared `libri` row for an ISBN, downloading and writing it only the first time it is seen.
+    """
+    def fetch_libro(isbn):
+        if db_api_handler.get_checkpoint().is_done("libro", isbn):
+            row = select_row("libri", "EAN", str(isbn), db_api_handler.get_db_handler())
+            if row is not None and row["Title"]:
+                return dict(row)  # Già salvato dalla sincronizzazione interrotta
+        new_param = {"libro_id": isbn, "api_handler": db_api_handler.get_api_handler()}
         db_api_handler.acquire_semaphore()
         try:
-            insert_data_from_api("libri", db_api_handler, new_param)
+            rows = insert_data_from_api("libri", db_api_handler, new_param)
+            if rows:
+                db_api_handler.mark_done("libro", isbn)
+        except RateLimitExceeded as error:
+            logger.warning("Libro '%s' non recuperato: %s", isbn, error)
+            return None
         finally:
             db_api_handler.release_semaphore()
+        return rows[0] if rows else None
 
-    db_api_handler.acquire_semaphore()
-    try:
-        insert_data_from_api("adozioni", db_api_handler, source_param_copy, source_dict_list)
-    finally:
-        db_api_handler.release_semaphore()
+    return db_api_handler.get_libri_registry().get_or_fetch(libro_id, fetch_libro)
 
 
-def worker(classe_id, source_param=None):
-    db_api_handler = DatabaseAPIHandler()  # Ogni worker crea la propria istanza
+def worker_initializer(db_writer=None, libri_registry=None, sync_state=None, checkpoint=None):
+    # Ogni worker del pool crea la propria istanza, riusata per i suoi task
+    return DatabaseAPIHandler(db_writer, libri_registry, sync_state, checkpoint)
 
-    db_api_handler.acquire_semaphore()
-    try:
-        adozione_classe(classe_id, db_api_handler, source_param)
-    finally:
-        db_api_handler.release_semaphore()
 
-    db_api_handler.close_connection()  # Chiusura della connessione al termine del lavoro
+def worker_finalizer(db_api_handler):
+    db_api_handler.close_connection()  # Chiusura della connessione alla terminazione del worker
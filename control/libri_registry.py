@@ -0,0 +1,74 @@
+from threading import RLock, Event
+
+
+class _Fetch:
+    def __init__(self):
+        self.done = Event()
+        self.completed = False
+        self.row = None
+
+
+class LibriRegistry:
+    """
+    Run-scoped registry of prepared `libri` rows, keyed by ISBN.
+    Each ISBN is fetched once per run: concurrent requests for an ISBN already in flight wait for
+    the first fetch and share its result instead of sending a second request. A failed lookup (None)
+    is not kept, so the next class adopting that ISBN tries again.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._rows = {}
+        self._in_flight = {}
+        self._stats = {"fetched": 0, "hits": 0, "coalesced": 0, "failed": 0}
+
+    def get_or_fetch(self, libro_id, fetch_function):
+        """
+        Return the cached row for libro_id, calling fetch_function(libro_id) only if no other
+        thread has fetched (or is fetching) it yet. If the fetch raises, waiters retry it themselves.
+        """
+        key = str(libro_id)
+        while True:
+            with self._lock:
+                if key in self._rows:
+                    self._stats["hits"] += 1
+                    return self._rows[key]
+                fetch = self._in_flight.get(key)
+                if fetch is None:
+                    fetch = self._in_flight[key] = _Fetch()
+                    break
+                self._stats["coalesced"] += 1
+            fetch.done.wait()
+            if fetch.completed:
+                return fetch.row
+
+        try:
+            row = fetch_function(libro_id)
+            with self._lock:
+                if row is not None:
+                    self._rows[key] = row
+                    self._stats["fetched"] += 1
+                else:
+                    self._stats["failed"] += 1
+            fetch.row, fetch.completed = row, True
+            return row
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            fetch.done.set()
+
+    def get(self, libro_id):
+        with self._lock:
+            return self._rows.get(str(libro_id))
+
+    def __contains__(self, libro_id):
+        with self._lock:
+            return str(libro_id) in self._rows
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
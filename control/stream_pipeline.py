@@ -0,0 +1,151 @@
+from threading import RLock, local
+from utils.log_utils import get_logger
+from utils.pipeline import Pipeline, Stage
+from api.adozioni_amazon_api import get_libri_adottati, retry_session
+from control.db_api_control import DatabaseAPIHandler, get_controllers, process_dict, libro_classe
+from control.sync_state import fingerprint_data
+
+logger = get_logger(__name__)
+
+
+class HandlerScope:
+    """
+    One DatabaseAPIHandler per pipeline thread, all closed together when the pipeline ends.
+    """
+
+    def __init__(self, db_writer=None, libri_registry=None, sync_state=None, checkpoint=None):
+        self._db_writer = db_writer
+        self._libri_registry = libri_registry
+        self._sync_state = sync_state
+        self._checkpoint = checkpoint
+        self._local = local()
+        self._lock = RLock()
+        self._handlers = []
+
+    def get(self):
+        db_api_handler = getattr(self._local, "db_api_handler", None)
+        if db_api_handler is None:
+            db_api_handler = DatabaseAPIHandler(self._db_writer, self._libri_registry, self._sync_state,
+                                                self._checkpoint)
+            self._local.db_api_handler = db_api_handler
+            with self._lock:
+                self._handlers.append(db_api_handler)
+        return db_api_handler
+
+    def close(self):
+        with self._lock:
+            handlers, self._handlers = self._handlers, []
+        for db_api_handler in handlers:
+            db_api_handler.close_connection()
+
+
+class AdozioniStream:
+    """
+    Adoption sync of many classes at once:
+    fetch adoption lists -> resolve their books -> prepare rows -> write, with bounded queues
+    between the stages. Preparation and writing run on a single thread each, so every row
+    reaches the writer in the order it was produced and books always precede their adoptions.
+    An adoption whose book could not be resolved is not written, and its class is left without
+    fingerprint and checkpoint so that the next run fetches it again.
+    """
+
+    def __init__(self, db_writer=None, libri_registry=None, sync_state=None, fetch_workers=15, max_queue_size=100,
+                 checkpoint=None):
+        self._handlers = HandlerScope(db_writer, libri_registry, sync_state, checkpoint)
+        self._pipeline = Pipeline([Stage("Adozioni", self.fetch_adozioni, fetch_workers),
+                                   Stage("Libri", self.fetch_libri, fetch_workers),
+                                   Stage("Trasformazione", self.transform, 1),
+                                   Stage("Scrittura", self.write, 1)], max_queue_size)
+
+    def start(self):
+        self._pipeline.start()
+        return self
+
+    def submit(self, classe_id, scuola_id):
+        self._pipeline.put((classe_id, scuola_id))
+
+    def join(self):
+        try:
+            return self._pipeline.join()
+        finally:
+            self._handlers.close()
+
+    def fetch_adozioni(self, item):
+        classe_id, scuola_id = item
+        db_api_handler = self._handlers.get()
+        if db_api_handler.get_checkpoint().is_done("classe", scuola_id, classe_id):
+            return None
+        source_params = {"classe_id": classe_id, "scuola_id": scuola_id,
+                         "api_handler": db_api_handler.get_api_handler()}
+        source_dict_list = retry_session(get_libri_adottati, source_params)
+        fingerprint = fingerprint_data(source_dict_list)
+        if db_api_handler.get_sync_state().is_unchanged(classe_id, scuola_id, fingerprint):
+            logger.debug("Adozioni della classe '%s' invariate dall'ultima sincronizzazione.", classe_id)
+            return classe_id, scuola_id, [], None  # Solo la voce del checkpoint
+        return classe_id, scuola_id, source_dict_list, fingerprint
+
+    def fetch_libri(self, item):
+        classe_id, scuola_id, source_dict_list, fingerprint = item
+        db_api_handler = self._handlers.get()
+        source_params = {"classe_id": classe_id, "scuola_id": scuola_id}
+        complete = True
+        for adozione in source_dict_list:
+            if libro_classe(adozione.get('ISBN'), db_api_handler) is None:
+                complete = False
+                continue  # Senza il libro l'adozione violerebbe la chiave esterna
+            yield "adozioni", source_params, adozione
+        if complete:
+            if fingerprint is not None:
+                yield "sincronizzazioni", source_params, fingerprint
+            yield "checkpoint", source_params, None
+
+    def transform(self, item):
+        table_name, source_params, source_dict = item
+        if table_name == "sincronizzazioni":
+            sync_state = self._handlers.get().get_sync_state()
+            return table_name, sync_state.sync_row(source_params["classe_id"], source_params["scuola_id"],
+                                                   source_dict)
+        if table_name == "checkpoint":
+            checkpoint = self._handlers.get().get_checkpoint()
+            return table_name, checkpoint.checkpoint_row("classe", source_params["scuola_id"],
+                                                         source_params["classe_id"])
+        prepare_dict = process_dict(table_name, source_params, source_dict)
+        return (table_name, prepare_dict) if prepare_dict is not None else None
+
+    def write(self, item):
+        table_name, row = item
+        self._handlers.get().write_rows(table_name, [row])
+
+    def queue_sizes(self):
+        return self._pipeline.queue_sizes()
+
+    def get_stats(self):
+        return self._pipeline.get_stats()
+
+
+def stream_data_from_api(table_name, source_params_list, db_writer=None, fetch_workers=4, max_queue_size=100):
+    """
+    Streaming counterpart of insert_data_from_api for many sources of the same table:
+    every source is fetched, its records are prepared one by one and written as they arrive.
+    """
+    handlers = HandlerScope(db_writer)
+    source_function = get_controllers()[table_name]["source"]
+
+    def fetch(source_param):
+        source_params = dict(source_param, api_handler=handlers.get().get_api_handler())
+        for source_dict in retry_session(source_function, source_params):
+            yield source_params, source_dict
+
+    def transform(item):
+        return process_dict(table_name, item[0], item[1])
+
+    def write(row):
+        handlers.get().write_rows(table_name, [row])
+
+    pipeline = Pipeline([Stage("Download", fetch, fetch_workers),
+                         Stage("Trasformazione", transform, 1),
+                         Stage("Scrittura", write, 1)], max_queue_size)
+    try:
+        return pipeline.run(source_params_list)
+    finally:
+        handlers.close()
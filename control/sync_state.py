@@ -0,0 +1,50 @@
+import json
+from datetime import datetime, timezone
+from hashlib import sha256
+from threading import RLock
+
+
+def fingerprint_data(source_dict_list):
+    """
+    Stable fingerprint of an API response: key order and whitespace do not affect it.
+    """
+    payload = json.dumps(source_dict_list, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SyncState:
+    """
+    Fingerprints of the adoption lists stored by the last successful sync, keyed by (CLID, COSCUO).
+    In incremental mode, classes whose current fingerprint matches are skipped entirely.
+    """
+
+    def __init__(self, fingerprints=None, incremental=False):
+        self._lock = RLock()
+        self._fingerprints = dict(fingerprints or {})
+        self._incremental = incremental
+        self._stats = {"skipped": 0, "changed": 0}
+
+    def is_unchanged(self, classe_id, scuola_id, fingerprint):
+        with self._lock:
+            unchanged = self._incremental and self._fingerprints.get((classe_id, scuola_id)) == fingerprint
+            self._stats["skipped" if unchanged else "changed"] += 1
+            return unchanged
+
+    def sync_row(self, classe_id, scuola_id, fingerprint):
+        """
+        Record a completed sync and return the `sincronizzazioni` row to persist with it.
+        """
+        with self._lock:
+            self._fingerprints[(classe_id, scuola_id)] = fingerprint
+        return {"CLID": classe_id,
+                "COSCUO": scuola_id,
+                "FINGERPRINT": fingerprint,
+                "SYNCED_AT": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+    @property
+    def incremental(self):
+        return self._incremental
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -1,46 +1,147 @@
-from threading import Thread
+from argparse import ArgumentParser
+from utils.log_utils import configure_logging
+from utils.metrics import get_metrics
 from utils.time_utils import measureTime, measureTimeString
-from control.db_api_control import DatabaseAPIHandler, tables_model, insert_data_from_api, get_controllers, worker
-from model.library import create_tables, retrieve_classe_ids
+from control.db_api_control import DatabaseAPIHandler, tables_model, insert_data_from_api, get_controllers
+from control.libri_registry import LibriRegistry
+from control.sync_state import SyncState
+from control.checkpoint import load_checkpoint
+from control.crawl_pipeline import CrawlPipeline
+from control.stream_pipeline import AdozioniStream
+from model.library import (DatabaseHandler, create_tables, retrieve_classe_ids, retrieve_fingerprints,
+                           close_connection_pools)
+from model.db_writer import DatabaseWriter
 
 
-def main():
+def main(num_workers=15, incremental=False, metrics_path=None, resume=False):
     tupleTime = measureTime()
-    db_api_handler = DatabaseAPIHandler()
-    db_handler = db_api_handler.get_db_handler()
+    db_writer = DatabaseWriter().start()  # Unico thread che scrive sul database
+    db_handler = DatabaseHandler()
+    db_api_handler = None
+    try:
+        tables_model_structure = tables_model()
+        create_tables(tables_model_structure, db_handler)
+        checkpoint = load_checkpoint(resume, db_handler)
+        db_api_handler = DatabaseAPIHandler(db_writer, checkpoint=checkpoint)
 
-    tables_model_structure = tables_model()
-    create_tables(tables_model_structure, db_handler)
+        controllers = get_controllers()
+        scuola_id = controllers["classi"]["source_params"]["scuola_id"]
+        if not checkpoint.is_done("scuola", scuola_id):
+            rows = [insert_data_from_api(table_name, db_api_handler) for table_name in ["scuole", "classi"]]
+            if all(rows):  # Scuola senza classi salvate: va scaricata di nuovo alla ripresa
+                db_api_handler.mark_done("scuola", scuola_id)
+        db_writer.flush()
 
-    for table_name in ["scuole", "classi"]:
-        insert_data_from_api(table_name, db_api_handler)
+        classe_ids = retrieve_classe_ids(scuola_id, db_handler)
+        print(f"Classi da recuperare: '{classe_ids}'")
 
-    controllers = get_controllers()
-    source_param = controllers[table_name]["source_params"]
-    classe_ids = retrieve_classe_ids(source_param["scuola_id"], db_handler)
-    print(f"Classi da recuperare: '{classe_ids}'")
+        libri_registry = LibriRegistry()  # Ogni ISBN viene scaricato una sola volta per esecuzione
+        sync_state = SyncState(retrieve_fingerprints(scuola_id, db_handler), incremental)
+        adozioni_stream = AdozioniStream(db_writer, libri_registry, sync_state, num_workers,
+                                         checkpoint=checkpoint).start()
+        for classe_id in classe_ids:
+            adozioni_stream.submit(classe_id, scuola_id)
+        errors = adozioni_stream.join()
 
-    num_threads = 15
-
-    threads = []
+        print(f"Elementi elaborati per fase: {adozioni_stream.get_stats()}")
+        print_stage_errors(errors)
+        print(f"Libri scaricati: {libri_registry.get_stats()}")
+        print(f"Sincronizzazione classi: {sync_state.get_stats()}")
+        print(f"Unità di lavoro: {checkpoint.get_stats()}")
+    finally:
+        close_run(db_writer, db_handler, db_api_handler)
+    export_metrics(metrics_path)
+    print(f"time: {measureTimeString(tupleTime)}")
 
-    for classe_id in classe_ids:
-        thread = Thread(target=worker, args=(classe_id, source_param))
-        thread.start()
-        print(f"Partenza Thread: {thread.ident}")
-        threads.append(thread)
 
-        if len(threads) >= num_threads:
-            for thread in threads:
-                thread.join()
-            threads = []
+def crawl(regioni_ids=None, province_ids=None, num_workers=15, discovery_workers=8, incremental=False,
+          gradi_ids=None, metrics_path=None, resume=False):
+    tupleTime = measureTime()
+    db_writer = DatabaseWriter().start()
+    db_handler = DatabaseHandler()
+    try:
+        create_tables(tables_model(), db_handler)
+        checkpoint = load_checkpoint(resume, db_handler)
 
-    for thread in threads:
-        thread.join()
+        libri_registry = LibriRegistry()
+        sync_state = SyncState(retrieve_fingerprints(None, db_handler), incremental)
+        pipeline = CrawlPipeline(db_writer, libri_registry, sync_state, discovery_workers, num_workers, gradi_ids,
+                                 checkpoint)
+        discovery_results, adoption_errors = pipeline.run(regioni_ids, province_ids)
 
-    db_handler.close_connection()
+        print(f"Nodi scoperti: {pipeline.get_stats()}")
+        print_task_errors(discovery_results, "Nodi della gerarchia")
+        print_stage_errors(adoption_errors)
+        print(f"Libri scaricati: {libri_registry.get_stats()}")
+        print(f"Sincronizzazione classi: {sync_state.get_stats()}")
+        print(f"Unità di lavoro: {checkpoint.get_stats()}")
+    finally:
+        close_run(db_writer, db_handler)
+    export_metrics(metrics_path)
     print(f"time: {measureTimeString(tupleTime)}")
 
 
+def close_run(db_writer, db_handler, db_api_handler=None):
+    """
+    Commit the rows still queued to the writer thread and release every connection, also when the run
+    stopped on an error; a failure of the writer thread is raised only after the connections are closed.
+    """
+    try:
+        db_writer.close()
+    finally:
+        if db_api_handler is not None:
+            db_api_handler.close_connection()
+        db_handler.close_connection()
+        close_connection_pools()
+
+
+def export_metrics(metrics_path=None):
+    """
+    Write the collected metrics to `<metrics_path>.json` and `<metrics_path>.prom` (Prometheus text format).
+    """
+    if metrics_path is None:
+        return
+    metrics = get_metrics()
+    metrics.to_json(f"{metrics_path}.json")
+    metrics.to_prometheus(f"{metrics_path}.prom")
+    print(f"Metriche salvate in '{metrics_path}.json' e '{metrics_path}.prom'")
+
+
+def print_task_errors(results, label):
+    failed = [task for task in results if task.error is not None]
+    print(f"{label} elaborate: {len(results) - len(failed)}, in errore: {len(failed)}")
+    for task in failed:
+        print(f"Errore in '{task.args}': {task.error!r}")
+
+
+def print_stage_errors(errors):
+    print(f"Errori nella pipeline delle adozioni: {len(errors)}")
+    for error in errors:
+        print(f"Errore nella fase '{error.stage}' per '{error.item}': {error.error!r}")
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Scarica le adozioni dei libri scolastici nel database locale.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="salta le classi con adozioni invariate dall'ultima sincronizzazione")
+    parser.add_argument("--resume", action="store_true",
+                        help="riprende l'ultima esecuzione interrotta saltando le unità di lavoro già completate")
+    parser.add_argument("--workers", type=int, default=15, help="numero di classi elaborate in parallelo")
+    parser.add_argument("--regione", action="append", help="codice di una regione da scansionare (es. 05)")
+    parser.add_argument("--provincia", action="append", help="sigla di una provincia da scansionare (es. VR)")
+    parser.add_argument("--grado", action="append", type=int, help="limita la scansione a un grado scolastico")
+    parser.add_argument("--metrics", metavar="PERCORSO",
+                        help="salva le metriche dell'esecuzione in PERCORSO.json e PERCORSO.prom")
+    parser.add_argument("--log-level", help="livello dei messaggi diagnostici (DEBUG, INFO, WARNING, ...); "
+                                            "predefinito ADOZIONI_LOG_LEVEL o WARNING")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    arguments = parse_arguments()
+    configure_logging(arguments.log_level)
+    if arguments.regione or arguments.provincia:
+        crawl(arguments.regione, arguments.provincia, arguments.workers, incremental=arguments.incremental,
+              gradi_ids=arguments.grado, metrics_path=arguments.metrics, resume=arguments.resume)
+    else:
+        main(arguments.workers, arguments.incremental, arguments.metrics, arguments.resume)
@@ -0,0 +1,254 @@
+from queue import Queue, Empty, Full
+from threading import Thread, Event, RLock
+from time import monotonic
+from model.library import DatabaseHandler, upsert_rows, unit_key
+from utils.log_utils import get_logger
+from utils.metrics import get_metrics, SIZE_BUCKETS
+
+logger = get_logger(__name__)
+
+_STOP = object()
+
+# Tabelle che registrano un'unità di lavoro come completata, e unità a cui appartiene ogni riga scritta
+JOURNAL_TABLES = ("checkpoint", "sincronizzazioni")
+ROW_UNITS = {"scuole": ("scuola", ("COSCUO",)),
+             "classi": ("scuola", ("COSCUO",)),
+             "libri": ("libro", ("EAN",)),
+             "adozioni": ("classe", ("COSCUO", "CLID")),
+             "sincronizzazioni": ("classe", ("COSCUO", "CLID"))}
+
+
+def row_unit(table_name, row):
+    """
+    The (unit, key) work unit a row belongs to, as journaled in `checkpoint`, or None.
+    """
+    if table_name == "checkpoint":
+        return row["UNIT"], row["UNIT_KEY"]
+    if table_name not in ROW_UNITS:
+        return None
+    unit, columns = ROW_UNITS[table_name]
+    return unit, unit_key(*map(row.get, columns))
+
+
+class _FlushRequest:
+    def __init__(self):
+        self.done = Event()
+
+
+class DatabaseWriter:
+    """
+    Single thread owning the sqlite connection used for writes.
+    Fetch workers enqueue prepared rows; the writer applies them in grouped transactions,
+    committing every `batch_size` rows or every `flush_interval` seconds, whichever comes first.
+    A row that cannot be written also discards the journal rows (checkpoint and fingerprint) of its work
+    unit, so the unit is fetched again by the next run. If the thread dies, the next call that waits for
+    it raises instead of blocking.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, database_handler_factory=DatabaseHandler, batch_size=500, flush_interval=1.0,
+                 max_queue_size=10000):
+        self._database_handler_factory = database_handler_factory
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = Queue(maxsize=max_queue_size)
+        self._lock = RLock()
+        self._thread = None
+        self._stats = {"inserted": 0, "updated": 0, "unchanged": 0, "transactions": 0, "errors": 0}
+        self._errors = []
+        self._failed_units = set()
+        self._failure = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="DatabaseWriter", daemon=True)
+                self._thread.start()
+                get_metrics().register_gauge("queue_depth", self._queue.qsize, stage="DatabaseWriter")
+                logger.info("DatabaseWriter: Thread di scrittura avviato!")
+        return self
+
+    def put_row(self, table_name, row):
+        self.start()
+        self._put((table_name, row))
+
+    def put_rows(self, table_name, rows):
+        for row in rows:
+            self.put_row(table_name, row)
+
+    def flush(self, timeout=None):
+        """
+        Block until every row enqueued so far has been committed.
+        """
+        self.start()
+        request = _FlushRequest()
+        self._put(request)
+        deadline = monotonic() + timeout if timeout is not None else None
+        while not request.done.wait(self.POLL_INTERVAL if deadline is None
+                                    else max(0.0, min(self.POLL_INTERVAL, deadline - monotonic()))):
+            self._check_alive()
+            if deadline is not None and monotonic() >= deadline:
+                return False
+        return True
+
+    def _put(self, item):
+        while True:
+            self._check_alive()
+            try:
+                self._queue.put(item, timeout=self.POLL_INTERVAL)
+                return
+            except Full:
+                continue
+
+    def _check_alive(self):
+        with self._lock:
+            thread = self._thread
+        if thread is not None and not thread.is_alive():
+            raise RuntimeError("DatabaseWriter: Il thread di scrittura è terminato") from self._failure
+
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            if thread.is_alive():
+                self._queue.put(_STOP)
+            thread.join()
+            get_metrics().unregister_gauge("queue_depth", stage="DatabaseWriter")
+            logger.info("DatabaseWriter: Thread di scrittura terminato %s", self.get_stats())
+        if self._failure is not None:
+            raise RuntimeError("DatabaseWriter: Il thread di scrittura è terminato per un errore") from self._failure
+
+    def _run(self):
+        database_handler = None
+        pending = []
+        deadline = monotonic() + self._flush_interval
+        try:
+            database_handler = self._database_handler_factory()
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - monotonic()))
+                except Empty:
+                    item = None
+
+                if item is _STOP:
+                    self._commit_batch(pending, database_handler)
+                    break
+                if isinstance(item, _FlushRequest):
+                    self._commit_batch(pending, database_handler)
+                    pending = []
+                    deadline = monotonic() + self._flush_interval
+                    item.done.set()
+                    continue
+                if item is not None:
+                    pending.append(item)
+
+                if len(pending) >= self._batch_size or monotonic() >= deadline:
+                    self._commit_batch(pending, database_handler)
+                    pending = []
+                    deadline = monotonic() + self._flush_interval
+        except BaseException as error:
+            # Chi attende il thread (flush, put_row, close) riceve l'errore invece di bloccarsi
+            self._failure = error
+            logger.error("DatabaseWriter: Thread di scrittura interrotto: %r", error)
+        finally:
+            if database_handler is not None:
+                database_handler.close_connection()
+
+    def _commit_batch(self, pending, database_handler):
+        pending = self._without_failed_journal_rows(pending)
+        if not pending:
+            return
+        get_metrics().observe("writer_batch_rows", len(pending), SIZE_BUCKETS)
+        try:
+            counts = self._write_pending(pending, database_handler)
+            database_handler.commit_connection()
+        except Exception as error:
+            database_handler.rollback_connection()
+            logger.warning("DatabaseWriter: Transazione di %d righe annullata (%r), riprovo riga per riga.",
+                           len(pending), error)
+            counts = self._commit_rows_individually(pending, database_handler)
+        with self._lock:
+            for key, value in counts.items():
+                self._stats[key] += value
+            self._stats["transactions"] += 1
+
+    def _write_pending(self, pending, database_handler):
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        for table_name, rows in group_consecutive_rows(pending):
+            for key, value in upsert_rows(table_name, rows, database_handler).items():
+                counts[key] += value
+        return counts
+
+    def _commit_rows_individually(self, pending, database_handler):
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        for item in pending:
+            if self._is_failed_journal_row(item):
+                continue  # Una riga precedente della stessa unità è stata scartata
+            try:
+                row_counts = self._write_pending([item], database_handler)
+                database_handler.commit_connection()
+            except Exception as error:
+                database_handler.rollback_connection()
+                self._record_error(item, error)
+                logger.error("DatabaseWriter: Riga scartata per la tabella '%s': %r", item[0], error)
+                unit = row_unit(*item)
+                if unit is not None:
+                    self._failed_units.add(unit)
+                continue
+            for key, value in row_counts.items():
+                counts[key] += value
+        return counts
+
+    def _without_failed_journal_rows(self, pending):
+        if not self._failed_units:
+            return pending
+        return [item for item in pending if not self._is_failed_journal_row(item)]
+
+    def _is_failed_journal_row(self, item):
+        """
+        Whether `item` journals a unit that lost a row; such a row is discarded and counted as an error.
+        """
+        if item[0] not in JOURNAL_TABLES:
+            return False
+        unit = row_unit(*item)
+        if unit not in self._failed_units:
+            return False
+        self._record_error(item, RuntimeError(f"Unità di lavoro incompleta: {unit}"))
+        logger.warning("DatabaseWriter: Riga scartata per la tabella '%s': l'unità %s è incompleta.", item[0], unit)
+        return True
+
+    def _record_error(self, item, error):
+        with self._lock:
+            self._stats["errors"] += 1
+            self._errors.append((item[0], item[1], error))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def get_errors(self):
+        with self._lock:
+            return list(self._errors)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def group_consecutive_rows(pending):
+    """
+    Group (table_name, row) items into runs of the same table, keeping the enqueue order
+    so that referenced rows are always written before the rows pointing at them.
+    """
+    groups = []
+    for table_name, row in pending:
+        if groups and groups[-1][0] == table_name:
+            groups[-1][1].append(row)
+        else:
+            groups.append((table_name, [row]))
+    return groups
@@ -0,0 +1,261 @@
+"""
+Streaming export of the library tables, and of the joined `adozioni_dettaglio` view, to CSV, JSONL or
+Parquet. Rows are read with fetchmany and written batch by batch, so memory does not grow with the
+table size. An incremental export writes only the rows changed since the previous export of the same
+name, looked up by the keys in the `modifiche` change log. Triggers fill the log only while at least one
+export is registered; removing the last one stops it.
+
+    python -m model.exporter adozioni_dettaglio export/adozioni.parquet [--incremental | --rimuovi]
+"""
+import csv
+import json
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from os import makedirs, replace, remove
+from os.path import dirname, abspath, splitext, exists
+from time import perf_counter
+from model.library import (DatabaseHandler, validate_database_handler, tables_model, views_model, table_columns,
+                           view_columns, table_primary_key, retrieve_export_cursor, store_export_cursor,
+                           remove_export_cursor, retrieve_last_change, prune_change_log)
+from utils.log_utils import get_logger
+from utils.metrics import get_metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # dipendenza opzionale, richiesta solo per l'esportazione in Parquet
+    pyarrow = None
+
+logger = get_logger(__name__)
+
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+EXPORT_TABLES = ("scuole", "classi", "libri", "adozioni")
+DETTAGLIO_VIEW = "adozioni_dettaglio"
+
+
+def logged_keys_sql(table_name):
+    """
+    Distinct primary keys of the `table_name` rows logged in `modifiche` after :last_seq and up to :upper_seq,
+    one column per key column.
+    """
+    keys = ", ".join(f"json_extract(CHIAVE, '$[{index}]') AS {column}"
+                     for index, column in enumerate(table_primary_key(table_name)))
+    return (f"SELECT DISTINCT {keys} FROM modifiche "
+            f"WHERE TABELLA = '{table_name}' AND SEQ > :last_seq AND SEQ <= :upper_seq")
+
+
+def export_source(source_name):
+    """
+    Columns of an exportable table or view, with their declared types, its key columns and the query
+    returning the keys of the rows changed between two change-log positions.
+    An adoption of the view also changes when its book, class or school does: those keys are followed
+    through the foreign keys of `adozioni`.
+    """
+    if source_name in EXPORT_TABLES:
+        return {"columns": table_columns(source_name),
+                "types": dict(tables_model()[source_name]["columns"]),
+                "keys": table_primary_key(source_name),
+                "changes": logged_keys_sql(source_name)}
+    if source_name == DETTAGLIO_VIEW:
+        columns_types = {column: column_type for table_name in EXPORT_TABLES
+                         for column, column_type in tables_model()[table_name]["columns"]}
+        keys = table_primary_key("adozioni")
+        changes = [f"SELECT {', '.join(keys)} FROM ({logged_keys_sql('adozioni')})"]
+        changes += [f"SELECT {', '.join(f'a.{key}' for key in keys)} FROM ({logged_keys_sql(table_name)}) k "
+                    f"JOIN adozioni a ON a.{column} = k.{reference}"
+                    for column, table_name, reference in tables_model()["adozioni"]["fk"]]
+        return {"columns": view_columns(source_name),
+                "types": columns_types,
+                "keys": keys,
+                "changes": " UNION ".join(changes)}
+    raise ValueError(f"Sorgente di esportazione sconosciuta: '{source_name}'")
+
+
+def export_query(source_name, source, incremental):
+    """
+    SELECT of the source columns; an incremental one starts from the changed keys and looks the rows up
+    by key instead of scanning the source.
+    """
+    columns = ", ".join(f"{source_name}.{column}" for column in source["columns"])
+    if not incremental:
+        return f"SELECT {columns} FROM {source_name}"
+    join_clause = " AND ".join(f"{source_name}.{key} = k.{key}" for key in source["keys"])
+    return f"SELECT {columns} FROM ({source['changes']}) k JOIN {source_name} ON {join_clause}"
+
+
+def arrow_type(column_type):
+    column_type = (column_type or "").upper()
+    if column_type.startswith("INTEGER"):
+        return pyarrow.int64()
+    if column_type.startswith(("NUMERIC", "REAL")):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+class CsvExportWriter:
+    def __init__(self, file, columns, column_types):
+        self._writer = csv.writer(file)
+        self._writer.writerow(columns)
+
+    def write_batch(self, rows):
+        self._writer.writerows(rows)
+
+
+class JsonlExportWriter:
+    def __init__(self, file, columns, column_types):
+        self._file = file
+        self._columns = columns
+
+    def write_batch(self, rows):
+        self._file.writelines(json.dumps(dict(zip(self._columns, row)), ensure_ascii=False) + "\n"
+                              for row in rows)
+
+
+class ParquetExportWriter:
+    """
+    One Parquet row group per fetched batch; the schema comes from the declared column types.
+    """
+
+    def __init__(self, file, columns, column_types):
+        if pyarrow is None:
+            raise RuntimeError("Esportazione in Parquet non disponibile: installare pyarrow")
+        self._columns = columns
+        self._schema = pyarrow.schema([(column, arrow_type(column_types.get(column))) for column in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(file, self._schema)
+
+    def write_batch(self, rows):
+        arrays = [pyarrow.array([row[index] for row in rows], type=field.type)
+                  for index, field in enumerate(self._schema)]
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "jsonl": JsonlExportWriter, "parquet": ParquetExportWriter}
+
+
+def export_format(filename, fmt=None):
+    fmt = (fmt or splitext(filename)[1].lstrip(".")).lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato di esportazione non supportato: '{fmt}' (ammessi: {', '.join(EXPORT_FORMATS)})")
+    return fmt
+
+
+def open_export_file(filename, fmt):
+    if fmt == "parquet":
+        return open(filename, "wb")
+    return open(filename, "w", encoding="utf-8", newline="")
+
+
+def export_rows(source_name, filename, fmt=None, incremental=False, export_name=None, batch_size=1000,
+                database_handler=None):
+    """
+    Stream a table or the `adozioni_dettaglio` view to `filename` (format taken from the extension unless
+    given) and return the number of rows written. The file is written next to its destination and moved
+    in place only when complete. With `incremental`, only the rows changed since the previous export named
+    `export_name` (by default the source and format) are written; the first one writes everything.
+    Every export records its position in the change log, so the next incremental one starts from there.
+    """
+    start = perf_counter()
+    fmt = export_format(filename, fmt)
+    source = export_source(source_name)
+    export_name = export_name or f"{source_name}.{fmt}"
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+
+    last_seq = retrieve_export_cursor(export_name, database_handler) if incremental else None
+    if not connection.in_transaction:
+        connection.execute("BEGIN")  # Lettura su un'unica istantanea: righe e posizione nel registro coincidono
+    upper_seq = retrieve_last_change(database_handler)
+    query = export_query(source_name, source, last_seq is not None)
+    parameters = {"last_seq": last_seq, "upper_seq": upper_seq}
+
+    makedirs(dirname(abspath(filename)), exist_ok=True)
+    temporary_filename = f"{filename}.tmp"
+    cursor = connection.cursor()
+    cursor.row_factory = None  # Tuple semplici: niente oggetti sqlite3.Row per ogni riga
+    cursor.arraysize = batch_size
+    exported = 0
+    try:
+        cursor.execute(query, parameters)
+        columns = [description[0] for description in cursor.description]
+        column_types = source["types"]
+        with open_export_file(temporary_filename, fmt) as file:
+            writer = EXPORT_WRITERS[fmt](file, columns, column_types)
+            try:
+                while True:
+                    rows = cursor.fetchmany()
+                    if not rows:
+                        break
+                    writer.write_batch(rows)
+                    exported += len(rows)
+            finally:
+                if hasattr(writer, "close"):
+                    writer.close()
+        replace(temporary_filename, filename)
+    except BaseException:
+        if exists(temporary_filename):
+            remove(temporary_filename)
+        raise
+    finally:
+        cursor.close()
+        connection.commit()
+
+    store_export_cursor(export_name, upper_seq, datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                        database_handler)
+    pruned = prune_change_log(database_handler)
+    elapsed = perf_counter() - start
+    metrics = get_metrics()
+    metrics.observe("export_seconds", elapsed, source=source_name, format=fmt)
+    metrics.increment("export_rows_total", exported, source=source_name, format=fmt)
+    logger.info("Exporter: '%s' -> '%s': %d righe %s in %.2f secondi (%d modifiche rimosse dal registro).",
+                source_name, filename, exported, "modificate" if last_seq is not None else "esportate",
+                elapsed, pruned)
+    return exported
+
+
+def remove_export(export_name, database_handler=None):
+    """
+    Unregister an incremental export and drop the change-log entries nobody needs any more.
+    """
+    database_handler = validate_database_handler(database_handler)
+    removed = remove_export_cursor(export_name, database_handler)
+    pruned = prune_change_log(database_handler)
+    logger.info("Exporter: Esportazione '%s' %s (%d modifiche rimosse dal registro).", export_name,
+                "rimossa" if removed else "non registrata", pruned)
+    return removed
+
+
+def export_sources():
+    return (*EXPORT_TABLES, *views_model())
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Esporta una tabella o la vista delle adozioni in CSV, JSONL o Parquet.")
+    parser.add_argument("sorgente", choices=export_sources())
+    parser.add_argument("percorso", help="file di destinazione; il formato è dedotto dall'estensione")
+    parser.add_argument("--formato", choices=EXPORT_FORMATS)
+    parser.add_argument("--incremental", action="store_true",
+                        help="esporta solo le righe modificate dall'esportazione precedente")
+    parser.add_argument("--nome", help="nome dell'esportazione incrementale (predefinito: sorgente.formato)")
+    parser.add_argument("--rimuovi", action="store_true",
+                        help="annulla la registrazione dell'esportazione incrementale invece di esportare")
+    parser.add_argument("--batch", type=int, default=1000, help="righe lette dal database per volta")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    db_handler = DatabaseHandler()
+    try:
+        if arguments.rimuovi:
+            name = arguments.nome or f"{arguments.sorgente}.{export_format(arguments.percorso, arguments.formato)}"
+            removed = remove_export(name, db_handler)
+            print(f"Esportazione '{name}' {'rimossa' if removed else 'non registrata'}")
+        else:
+            rows_count = export_rows(arguments.sorgente, arguments.percorso, arguments.formato,
+                                     arguments.incremental, arguments.nome, arguments.batch, db_handler)
+            print(f"Righe esportate in '{arguments.percorso}': {rows_count}")
+    finally:
+        db_handler.close_connection()
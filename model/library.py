@@ -1,45 +1,291 @@
+import json
+import re
 import sqlite3
-from os.path import join, dirname
+from functools import lru_cache
+from hashlib import blake2b
+from os import makedirs, environ
+from os.path import join, dirname, abspath
+from threading import RLock, get_ident
+from time import perf_counter
+from utils.log_utils import get_logger
+from utils.metrics import get_metrics
+
+logger = get_logger(__name__)
+
+
+def connection_profile():
+    """
+    Pragmas applied to every connection: WAL lets readers run alongside the writer, NORMAL sync is
+    durable at every checkpoint under WAL, and the busy timeout makes contending connections wait
+    for the lock instead of failing with `database is locked`.
+    """
+    return {"journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -64000,  # KiB, circa 64 MB di cache delle pagine
+            "mmap_size": 256 * 1024 * 1024,
+            "temp_store": "MEMORY",
+            "busy_timeout": 30000,  # ms
+            "foreign_keys": "ON"}
+
+
+def row_hash(*values):
+    """
+    Content hash of a row's values, in model column order. Integral floats hash like the integers
+    sqlite stores for them in NUMERIC columns, so a hash computed in Python matches one computed in SQL.
+    """
+    values = [int(value) if isinstance(value, float) and value.is_integer() else value for value in values]
+    payload = json.dumps(values, separators=(",", ":"), ensure_ascii=False, default=str)
+    return blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def open_connection(filename, profile=None):
+    makedirs(dirname(abspath(filename)), exist_ok=True)
+    conn = sqlite3.connect(filename, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("row_hash", -1, row_hash, deterministic=True)
+    for pragma, value in (profile if profile is not None else connection_profile()).items():
+        conn.execute(f"PRAGMA {pragma} = {value};")
+    return conn
+
+
+class ConnectionPool:
+    """
+    One open connection per thread, reused by every DatabaseHandler created on that thread.
+    Connections are only closed by `close()`, so short-lived handlers stop paying for the
+    connection setup and the pragmas on each task.
+    """
+
+    def __init__(self, filename, profile=None):
+        self._filename = filename
+        self._profile = profile if profile is not None else connection_profile()
+        self._lock = RLock()
+        self._connections = {}
+        self._users = {}
+
+    def acquire(self):
+        ident = get_ident()
+        with self._lock:
+            connection = self._connections.get(ident)
+            if connection is None:
+                connection = open_connection(self._filename, self._profile)
+                self._connections[ident] = connection
+                logger.info("ConnectionPool: Il database %s è stato aperto correttamente!", self._filename)
+            self._users[ident] = self._users.get(ident, 0) + 1
+            return connection
+
+    def release(self, connection):
+        """
+        Give a connection back to the pool, possibly from another thread; once its last handler
+        releases it, whatever was left uncommitted is rolled back, as closing it would have done.
+        """
+        with self._lock:
+            ident = next((key for key, value in self._connections.items() if value is connection), None)
+            if ident is None:
+                return
+            users = self._users.get(ident, 0) - 1
+            if users > 0:
+                self._users[ident] = users
+                return
+            self._users.pop(ident, None)
+        if connection.in_transaction:
+            connection.rollback()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+            self._users = {}
+        for connection in connections.values():
+            connection.close()
+        if connections:
+            logger.info("ConnectionPool: Chiuse %d connessioni al database %s", len(connections), self._filename)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._connections)
+
+
+_connection_pools = {}
+_connection_pools_lock = RLock()
+
+
+def get_connection_pool(filename, profile=None):
+    with _connection_pools_lock:
+        pool = _connection_pools.get(filename)
+        if pool is None:
+            pool = ConnectionPool(filename, profile)
+            _connection_pools[filename] = pool
+        return pool
+
+
+def close_connection_pools():
+    with _connection_pools_lock:
+        pools = list(_connection_pools.values())
+        _connection_pools.clear()
+    for pool in pools:
+        pool.close()
 
 
 class DatabaseHandler:
-    def __init__(self):
-        self._filename_db = join(dirname(__file__), "../data", "library.db")
+    def __init__(self, filename=None, profile=None, pooled=True):
+        self._filename_db = filename or environ.get("ADOZIONI_DB_PATH") or join(dirname(__file__), "../data",
+                                                                                "library.db")
+        self._profile = profile
+        self._pool = get_connection_pool(self._filename_db, profile) if pooled else None
         self._connection = None
 
     def get_db_connection(self):
         if self._connection is None:
-            print("DatabaseHandler: Nuova Connessione!")
-            self._connection = self.get_connection()
+            logger.debug("DatabaseHandler: Nuova Connessione!")
+            self._connection = self._pool.acquire() if self._pool is not None else self.get_connection()
         else:
-            print("DatabaseHandler: Riutilizzo Connessione!")
+            logger.debug("DatabaseHandler: Riutilizzo Connessione!")
         return self._connection
 
     def get_connection(self):
-        conn = sqlite3.connect(self._filename_db)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys = ON;")
-        print(f"DatabaseHandler: Il database {self._filename_db} è stato aperto correttamente!")
+        conn = open_connection(self._filename_db, self._profile)
+        logger.info("DatabaseHandler: Il database %s è stato aperto correttamente!", self._filename_db)
         return conn
 
     def commit_connection(self):
-        print(f"DatabaseHandler: Commit completata con successo!")
-        self._connection.commit()
+        with get_metrics().timer("db_commit_seconds"):
+            self._connection.commit()
+        logger.debug("DatabaseHandler: Commit completata con successo!")
+
+    def rollback_connection(self):
+        if self._connection is not None:
+            self._connection.rollback()
+            logger.info("DatabaseHandler: Rollback eseguito!")
 
     def close_connection(self):
+        if self._connection is None:
+            return
+        if self._pool is not None:
+            self._pool.release(self._connection)  # La connessione resta aperta per il thread corrente
+            self._connection = None
+            logger.debug("DatabaseHandler: Connessione al database %s restituita al pool", self._filename_db)
+            return
         self._connection.close()
-        print(f"DatabaseHandler: Il database {self._filename_db} è stato chiuso correttamente")
+        self._connection = None
+        logger.info("DatabaseHandler: Il database %s è stato chiuso correttamente", self._filename_db)
 
 
 def validate_database_handler(database_handler=None):
     if database_handler is None and not isinstance(database_handler, DatabaseHandler):
-        print("DatabaseHandler: Creazione di una nuova istanza!")
+        logger.debug("DatabaseHandler: Creazione di una nuova istanza!")
         database_handler = DatabaseHandler()
     else:
-        print("DatabaseHandler: Riutilizzo dell'istanza!")
+        logger.debug("DatabaseHandler: Riutilizzo dell'istanza!")
     return database_handler
 
 
+CHANGE_LOG_CONDITION = "EXISTS (SELECT 1 FROM esportazioni)"
+
+
+def change_log_triggers(table_name, pk):
+    """
+    Triggers recording every inserted or updated row of a table in `modifiche`, keyed by the JSON array
+    of its primary key values; unchanged rows are skipped by the upsert and leave no trace.
+    The log is written only while an export is registered in `esportazioni`, its only reader.
+    """
+    key_sql = f"json_array({', '.join(f'NEW.{column}' for column in pk)})"
+    body = f"INSERT INTO modifiche (TABELLA, CHIAVE) VALUES ('{table_name}', {key_sql})"
+    return [(f"{table_name}_modifiche_insert", "AFTER INSERT", body, CHANGE_LOG_CONDITION),
+            (f"{table_name}_modifiche_update", "AFTER UPDATE", body, CHANGE_LOG_CONDITION)]
+
+
+RIEPILOGO_COLUMNS = ("LIBRI", "DA_ACQUISTARE", "TOTALE", "PREZZI_MANCANTI", "NUOVE_ADOZIONI")
+
+
+def summary_upsert_sql(table_name, pk, columns, select_sql):
+    """
+    INSERT ... SELECT that rewrites a summary row only when one of its values changed.
+    """
+    set_clause = ", ".join([f"{column} = excluded.{column}" for column in columns])
+    changed_clause = " OR ".join([f"{table_name}.{column} IS NOT excluded.{column}" for column in columns])
+    return (f"INSERT INTO {table_name} ({', '.join([*pk, *columns])}) {select_sql} "
+            f"ON CONFLICT ({', '.join(pk)}) DO UPDATE SET {set_clause} WHERE {changed_clause}")
+
+
+def riepilogo_classi_sql(where_sql):
+    """
+    Recompute the summary of the classes selected by `where_sql` (a condition on the adozioni alias `a`)
+    from their adoptions joined with the book prices.
+    """
+    select_sql = ("SELECT a.CLID, a.COSCUO, COUNT(*), SUM(a.DA_ACQUISTARE = 'Si'), "
+                  "ROUND(TOTAL(CASE WHEN a.DA_ACQUISTARE = 'Si' THEN l.Price END), 2), "
+                  "SUM(a.DA_ACQUISTARE = 'Si' AND l.Price IS NULL), SUM(a.NUOVA_ADOZIONE = 'Si') "
+                  f"FROM adozioni a LEFT JOIN libri l ON l.EAN = a.ISBN WHERE {where_sql} "
+                  "GROUP BY a.CLID, a.COSCUO")
+    return summary_upsert_sql("riepilogo_classi", ("CLID", "COSCUO"), RIEPILOGO_COLUMNS, select_sql)
+
+
+def riepilogo_scuole_sql(where_sql):
+    """
+    Recompute the summary of the schools selected by `where_sql` (a condition on riepilogo_classi)
+    from the summaries of their classes.
+    """
+    select_sql = ("SELECT COSCUO, COUNT(*), SUM(LIBRI), SUM(DA_ACQUISTARE), ROUND(TOTAL(TOTALE), 2), "
+                  f"SUM(PREZZI_MANCANTI), SUM(NUOVE_ADOZIONI) FROM riepilogo_classi WHERE {where_sql} GROUP BY COSCUO")
+    return summary_upsert_sql("riepilogo_scuole", ("COSCUO",), ("CLASSI", *RIEPILOGO_COLUMNS), select_sql)
+
+
+def riepilogo_adozioni_triggers():
+    """
+    Keep riepilogo_classi current: a written or deleted adoption recomputes its own class only.
+    """
+    class_sql = "a.CLID = {row}.CLID AND a.COSCUO = {row}.COSCUO"
+    changed_sql = ("OLD.DA_ACQUISTARE IS NOT NEW.DA_ACQUISTARE OR OLD.NUOVA_ADOZIONE IS NOT NEW.NUOVA_ADOZIONE "
+                   "OR OLD.ISBN IS NOT NEW.ISBN")
+    delete_sql = ("DELETE FROM riepilogo_classi WHERE CLID = OLD.CLID AND COSCUO = OLD.COSCUO AND NOT EXISTS "
+                  "(SELECT 1 FROM adozioni WHERE CLID = OLD.CLID AND COSCUO = OLD.COSCUO)")
+    return [("adozioni_riepilogo_insert", "AFTER INSERT", riepilogo_classi_sql(class_sql.format(row="NEW"))),
+            ("adozioni_riepilogo_update", "AFTER UPDATE", riepilogo_classi_sql(class_sql.format(row="NEW")),
+             changed_sql),
+            ("adozioni_riepilogo_delete", "AFTER DELETE",
+             f"{riepilogo_classi_sql(class_sql.format(row='OLD'))}; {delete_sql}")]
+
+
+def riepilogo_libri_triggers():
+    """
+    A book whose price appears or changes recomputes the classes adopting it.
+    """
+    classes_sql = "(a.CLID, a.COSCUO) IN (SELECT CLID, COSCUO FROM adozioni WHERE ISBN = NEW.EAN)"
+    return [("libri_riepilogo_insert", "AFTER INSERT", riepilogo_classi_sql(classes_sql)),
+            ("libri_riepilogo_update", "AFTER UPDATE", riepilogo_classi_sql(classes_sql),
+             "OLD.Price IS NOT NEW.Price")]
+
+
+def riepilogo_classi_triggers():
+    """
+    Keep riepilogo_scuole current from the class summaries of the same school.
+    """
+    delete_sql = ("DELETE FROM riepilogo_scuole WHERE COSCUO = OLD.COSCUO AND NOT EXISTS "
+                  "(SELECT 1 FROM riepilogo_classi WHERE COSCUO = OLD.COSCUO)")
+    return [("riepilogo_classi_insert", "AFTER INSERT", riepilogo_scuole_sql("COSCUO = NEW.COSCUO")),
+            ("riepilogo_classi_update", "AFTER UPDATE", riepilogo_scuole_sql("COSCUO = NEW.COSCUO")),
+            ("riepilogo_classi_delete", "AFTER DELETE",
+             f"{riepilogo_scuole_sql('COSCUO = OLD.COSCUO')}; {delete_sql}")]
+
+
+LIBRI_FTS_COLUMNS = ("Title", "Author", "Publisher")
+
+
+def libri_fts_triggers():
+    """
+    Keep the external-content index libri_fts in step with libri: its rows are addressed by the libri rowid
+    and an update re-indexes the book only when one of the searched columns changed.
+    """
+    columns = ", ".join(LIBRI_FTS_COLUMNS)
+    insert_sql = (f"INSERT INTO libri_fts (rowid, {columns}) "
+                  f"VALUES (NEW.rowid, {', '.join(f'NEW.{column}' for column in LIBRI_FTS_COLUMNS)})")
+    delete_sql = (f"INSERT INTO libri_fts (libri_fts, rowid, {columns}) "
+                  f"VALUES ('delete', OLD.rowid, {', '.join(f'OLD.{column}' for column in LIBRI_FTS_COLUMNS)})")
+    changed_sql = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in LIBRI_FTS_COLUMNS)
+    return [("libri_fts_insert", "AFTER INSERT", insert_sql),
+            ("libri_fts_delete", "AFTER DELETE", delete_sql),
+            ("libri_fts_update", "AFTER UPDATE", f"{delete_sql}; {insert_sql}", changed_sql)]
+
+
 def table_scuole_model():
     return {"columns": [("COSCUO", "TEXT"),
                         ("DESIS", "TEXT"),
@@ -50,7 +296,11 @@ def table_scuole_model():
                         ("LOCSCU", "TEXT")],
             "pk": ["COSCUO"],
             "fk": [],
-            "check": []}
+            "check": [],
+            "indexes": [],
+            "options": [],
+            "triggers": change_log_triggers("scuole", ["COSCUO"]),
+            "hash_column": "ROW_HASH"}
 
 
 def table_classi_model():
@@ -62,7 +312,11 @@ def table_classi_model():
                         ("DESCOMB", "TEXT")],
             "pk": ["CLID"],
             "fk": [("COSCUO", "scuole", "COSCUO")],
-            "check": []}
+            "check": [],
+            "indexes": [("classi_coscuo", ["COSCUO"])],
+            "options": [],
+            "triggers": change_log_triggers("classi", ["CLID"]),
+            "hash_column": "ROW_HASH"}
 
 
 def table_libri_model():
@@ -77,7 +331,11 @@ def table_libri_model():
                         ("Price", "NUMERIC(5,2)")],
             "pk": ["EAN"],
             "fk": [],
-            "check": []}
+            "check": [],
+            "indexes": [],
+            "options": [],
+            "triggers": [*change_log_triggers("libri", ["EAN"]), *riepilogo_libri_triggers(), *libri_fts_triggers()],
+            "hash_column": "ROW_HASH"}
 
 
 def table_adozioni_model():
@@ -94,14 +352,147 @@ def table_adozioni_model():
                    ("COSCUO", "scuole", "COSCUO")],
             "check": [("NUOVA_ADOZIONE", ('Si', 'No')),
                       ("CONSIGLIATO", ('Si', 'No')),
-                      ("DA_ACQUISTARE", ('Si', 'No'))]}
+                      ("DA_ACQUISTARE", ('Si', 'No'))],
+            "indexes": [("adozioni_classe", ["CLID", "COSCUO"]),
+                        ("adozioni_scuola", ["COSCUO"])],
+            "options": ["WITHOUT ROWID"],
+            "triggers": [*change_log_triggers("adozioni", ["ISBN", "CLID", "COSCUO"]),
+                         *riepilogo_adozioni_triggers()],
+            "hash_column": "ROW_HASH"}
+
+
+def table_sincronizzazioni_model():
+    return {"columns": [("CLID", "INTEGER"),
+                        ("COSCUO", "TEXT"),
+                        ("FINGERPRINT", "TEXT"),
+                        ("SYNCED_AT", "TEXT")],
+            "pk": ["CLID", "COSCUO"],
+            "fk": [("CLID", "classi", "CLID")],
+            "check": [],
+            "indexes": [("sincronizzazioni_scuola", ["COSCUO"])],
+            "options": ["WITHOUT ROWID"]}
+
+
+def table_checkpoint_model():
+    return {"columns": [("UNIT", "TEXT"),
+                        ("UNIT_KEY", "TEXT"),
+                        ("COMPLETED_AT", "TEXT")],
+            "pk": ["UNIT", "UNIT_KEY"],
+            "fk": [],
+            "check": [("UNIT", ('scuola', 'classe', 'libro'))],
+            "indexes": [],
+            "options": ["WITHOUT ROWID"]}
+
+
+def table_modifiche_model():
+    return {"columns": [("SEQ", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+                        ("TABELLA", "TEXT"),
+                        ("CHIAVE", "TEXT")],
+            "pk": [],
+            "fk": [],
+            "check": [],
+            "indexes": [("modifiche_tabella", ["TABELLA", "SEQ"])],
+            "options": []}
+
+
+def table_esportazioni_model():
+    return {"columns": [("NOME", "TEXT"),
+                        ("LAST_SEQ", "INTEGER"),
+                        ("EXPORTED_AT", "TEXT")],
+            "pk": ["NOME"],
+            "fk": [],
+            "check": [],
+            "indexes": [],
+            "options": []}
+
+
+def table_libri_fts_model():
+    return {"columns": [(column, "") for column in LIBRI_FTS_COLUMNS],
+            "pk": [],
+            "fk": [],
+            "check": [],
+            "indexes": [],
+            "options": [],
+            "module": "fts5",
+            "module_args": ["content='libri'", "content_rowid='rowid'",
+                            "tokenize='unicode61 remove_diacritics 2'", "prefix='2 3'"],
+            "populate": "INSERT INTO libri_fts (libri_fts) VALUES ('rebuild')"}
+
+
+def table_riepilogo_classi_model():
+    return {"columns": [("CLID", "INTEGER"),
+                        ("COSCUO", "TEXT"),
+                        ("LIBRI", "INTEGER"),
+                        ("DA_ACQUISTARE", "INTEGER"),
+                        ("TOTALE", "NUMERIC(7,2)"),
+                        ("PREZZI_MANCANTI", "INTEGER"),
+                        ("NUOVE_ADOZIONI", "INTEGER")],
+            "pk": ["CLID", "COSCUO"],
+            "fk": [],
+            "check": [],
+            "indexes": [("riepilogo_classi_scuola", ["COSCUO"])],
+            "options": ["WITHOUT ROWID"],
+            "triggers": riepilogo_classi_triggers(),
+            "populate": riepilogo_classi_sql("1")}
+
+
+def table_riepilogo_scuole_model():
+    return {"columns": [("COSCUO", "TEXT"),
+                        ("CLASSI", "INTEGER"),
+                        ("LIBRI", "INTEGER"),
+                        ("DA_ACQUISTARE", "INTEGER"),
+                        ("TOTALE", "NUMERIC(9,2)"),
+                        ("PREZZI_MANCANTI", "INTEGER"),
+                        ("NUOVE_ADOZIONI", "INTEGER")],
+            "pk": ["COSCUO"],
+            "fk": [],
+            "check": [],
+            "indexes": [],
+            "options": ["WITHOUT ROWID"]}
 
 
 def tables_model():
     return {"scuole": table_scuole_model(),
             "classi": table_classi_model(),
             "libri": table_libri_model(),
-            "adozioni": table_adozioni_model()}
+            "adozioni": table_adozioni_model(),
+            "sincronizzazioni": table_sincronizzazioni_model(),
+            "checkpoint": table_checkpoint_model(),
+            "modifiche": table_modifiche_model(),
+            "esportazioni": table_esportazioni_model(),
+            "riepilogo_scuole": table_riepilogo_scuole_model(),
+            "riepilogo_classi": table_riepilogo_classi_model(),
+            "libri_fts": table_libri_fts_model()}
+
+
+ADOZIONI_DETTAGLIO_COLUMNS = (("a", ("ISBN", "CLID", "COSCUO", "DESC_DISCIPLINA", "NUOVA_ADOZIONE", "CONSIGLIATO",
+                                      "DA_ACQUISTARE")),
+                              ("l", ("Title", "Author", "Publisher", "PublicationDate", "Price", "DetailPageURL")),
+                              ("c", ("ASCO", "CLASSE", "SEZION", "DESCOMB")),
+                              ("s", ("NOMSCU", "DESIS", "TIPO_SCUOLA", "INDSCU", "CAPSCU", "LOCSCU")))
+
+
+def view_columns(view_name):
+    """
+    Column names of a view, in select order.
+    """
+    if view_name == "adozioni_dettaglio":
+        return tuple(column for _, columns in ADOZIONI_DETTAGLIO_COLUMNS for column in columns)
+    raise ValueError(f"Vista sconosciuta: '{view_name}'")
+
+
+def views_model():
+    """
+    Read-only views created with the tables. `adozioni_dettaglio` joins every adoption with its book,
+    class and school, one row per adoption.
+    """
+    dettaglio_columns = ", ".join(f"{alias}.{column}" for alias, columns in ADOZIONI_DETTAGLIO_COLUMNS
+                                  for column in columns)
+    return {"adozioni_dettaglio": f"SELECT {dettaglio_columns} "
+                                  "FROM adozioni a "
+                                  "LEFT JOIN libri l ON l.EAN = a.ISBN "
+                                  "LEFT JOIN classi c ON c.CLID = a.CLID "
+                                  "LEFT JOIN scuole s ON s.COSCUO = a.COSCUO"}
 
 
 def format_columns(columns):
@@ -113,57 +504,331 @@ def format_primary_key(pk):
 
 
 def format_foreign_keys(fk):
-    return ", ".join([f"FOREIGN KEY ({col[0]}) REFERENCES {col[1]}({col[2]})" for col in fk])
+    return "".join([f", FOREIGN KEY ({col[0]}) REFERENCES {col[1]}({col[2]})" for col in fk])
 
 
 def format_checks(check):
-    return ", ".join([f"CHECK ({col[0]} IN {col[1]})" for col in check])
+    return "".join([f", CHECK ({col[0]} IN {col[1]})" for col in check])
+
+
+def format_hash_column(hash_column):
+    return f", {hash_column} TEXT" if hash_column else ""
+
+
+def format_options(options):
+    return f" {', '.join(options)}" if options else ""
+
+
+def create_virtual_table_sql(table_name, table_model):
+    arguments = [column[0] for column in table_model["columns"]] + table_model.get("module_args", [])
+    return f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING {table_model['module']}({', '.join(arguments)})"
 
 
 def create_table_sql(table_name, table_model):
-    columns_sql = format_columns(table_model["columns"])
+    if "module" in table_model:
+        return create_virtual_table_sql(table_name, table_model)
+    columns_sql = format_columns(table_model["columns"]) + format_hash_column(table_model.get("hash_column"))
     pk_sql = format_primary_key(table_model["pk"])
     fk_sql = format_foreign_keys(table_model["fk"])
     check_sql = format_checks(table_model["check"])
+    options_sql = format_options(table_model.get("options", []))
 
-    sql = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_sql}{pk_sql}{fk_sql}{check_sql})"
+    sql = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_sql}{pk_sql}{fk_sql}{check_sql}){options_sql}"
     return sql
 
 
+def create_indexes_sql(table_name, table_model):
+    return [f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(columns)})"
+            for index_name, columns in table_model.get("indexes", [])]
+
+
+def format_trigger_condition(trigger):
+    return f" WHEN {trigger[3]}" if len(trigger) > 3 else ""
+
+
+def create_trigger_sql(table_name, trigger):
+    """
+    Triggers are (name, event, body) tuples, with an optional fourth WHEN condition. The statement is
+    written as sqlite stores it in sqlite_master, so a trigger can be compared with its model.
+    """
+    return (f"CREATE TRIGGER {trigger[0]} {trigger[1]} ON {table_name}"
+            f"{format_trigger_condition(trigger)} BEGIN {trigger[2]}; END")
+
+
+def sync_triggers(table_name, table_model, connection):
+    """
+    Create the triggers of a table, replacing those whose stored definition no longer matches the model.
+    """
+    stored = {row[0]: row[1] for row in connection.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table_name,))}
+    for trigger in table_model.get("triggers", []):
+        trigger_sql = create_trigger_sql(table_name, trigger)
+        if stored.get(trigger[0]) == trigger_sql:
+            continue
+        if trigger[0] in stored:
+            connection.execute(f"DROP TRIGGER {trigger[0]}")
+            logger.info("DatabaseHandler: Il trigger '%s' è stato aggiornato.", trigger[0])
+        connection.execute(trigger_sql)
+
+
+def create_view_sql(view_name, select_sql):
+    return f"CREATE VIEW IF NOT EXISTS {view_name} AS {select_sql}"
+
+
+@lru_cache(maxsize=None)
+def table_columns(table_name):
+    """
+    Column names of a table, in schema order, computed once per process.
+    """
+    return tuple(col[0] for col in tables_model()[table_name]["columns"])
+
+
+@lru_cache(maxsize=None)
+def table_column_set(table_name):
+    return frozenset(table_columns(table_name))
+
+
+@lru_cache(maxsize=None)
+def table_primary_key(table_name):
+    return tuple(tables_model()[table_name]["pk"])
+
+
+def normalize_key(pk_name, pk_value):
+    """
+    Accept either a single key column and value or the full (possibly composite) key as sequences.
+    """
+    if isinstance(pk_name, str):
+        return (pk_name,), (pk_value,)
+    return tuple(pk_name), tuple(pk_value)
+
+
+@lru_cache(maxsize=None)
+def key_clause(pk_names):
+    return " AND ".join([f"{column} = ?" for column in pk_names])
+
+
+@lru_cache(maxsize=None)
+def select_row_sql(table_name, pk_names):
+    return f"SELECT * FROM {table_name} WHERE {key_clause(pk_names)}"
+
+
+@lru_cache(maxsize=None)
+def update_row_sql(table_name, columns, pk_names):
+    set_clause = ", ".join([f"{column} = ?" for column in columns])
+    return f"UPDATE {table_name} SET {set_clause} WHERE {key_clause(pk_names)}"
+
+
+@lru_cache(maxsize=None)
+def insert_row_sql(table_name, columns):
+    columns_string = ", ".join(columns)
+    placeholders = ", ".join(["?" for _ in columns])  # Generazione dei segnaposto
+    return f"INSERT INTO {table_name} ({columns_string}) VALUES ({placeholders})"
+
+
 def select_row(table_name, pk_name, pk_value, database_handler=None):
     database_handler = validate_database_handler(database_handler)
     connection = database_handler.get_db_connection()
-    query = f"SELECT * FROM {table_name} WHERE {pk_name} = ?"
-    cursor = connection.execute(query, (pk_value,))
+    pk_names, pk_values = normalize_key(pk_name, pk_value)
+    cursor = connection.execute(select_row_sql(table_name, pk_names), pk_values)
     return cursor.fetchone()
 
 
 def update_row(table_name, columns, values, pk_name, pk_value, database_handler=None):
     database_handler = validate_database_handler(database_handler)
     connection = database_handler.get_db_connection()
-    set_clause = ", ".join([f"{column} = ?" for column in columns])
-    query = f"UPDATE {table_name} SET {set_clause} WHERE {pk_name} = ?"
-    parameters = (*values, pk_value)  # Creazione dei parametri per la query
+    pk_names, pk_values = normalize_key(pk_name, pk_value)
+    query = update_row_sql(table_name, tuple(columns), pk_names)
+    parameters = (*values, *pk_values)  # Creazione dei parametri per la query
     connection.execute(query, parameters)  # Esecuzione della query con i parametri
 
 
 def insert_row(table_name, columns, values, database_handler=None):
     database_handler = validate_database_handler(database_handler)
     connection = database_handler.get_db_connection()
+    connection.execute(insert_row_sql(table_name, tuple(columns)), values)
+
+
+SQLITE_MAX_VARIABLES = 999
+
+
+@lru_cache(maxsize=None)
+def upsert_row_sql(table_name, columns, pk, hash_column=None):
+    """
+    Build a set-based upsert that only rewrites rows whose non-key values actually changed. With a hash
+    column (passed last in `columns`) the change test is a single comparison of the stored content hash.
+    """
     columns_string = ", ".join(columns)
-    placeholders = ", ".join(["?" for _ in values])  # Generazione dei segnaposto
-    query = f"INSERT INTO {table_name} ({columns_string}) VALUES ({placeholders})"
-    connection.execute(query, values)
+    placeholders = ", ".join(["?" for _ in columns])
+    sql = f"INSERT INTO {table_name} ({columns_string}) VALUES ({placeholders}) ON CONFLICT ({', '.join(pk)}) DO "
+    update_columns = [column for column in columns if column not in pk]
+    if not update_columns:
+        return f"{sql}NOTHING"
+    set_clause = ", ".join([f"{column} = excluded.{column}" for column in update_columns])
+    compared_columns = [hash_column] if hash_column else update_columns
+    changed_clause = " OR ".join([f"{table_name}.{column} IS NOT excluded.{column}" for column in compared_columns])
+    return f"{sql}UPDATE SET {set_clause} WHERE {changed_clause}"
+
+
+@lru_cache(maxsize=None)
+def table_hash_column(table_name):
+    return tables_model()[table_name].get("hash_column")
+
+
+@lru_cache(maxsize=None)
+def table_upsert_plan(table_name):
+    """
+    What upsert_rows needs for a table, compiled once per process: column order, primary key and its
+    position in a row, content hash column and the upsert statement.
+    """
+    columns = table_columns(table_name)
+    pk = table_primary_key(table_name)
+    hash_column = table_hash_column(table_name)
+    return {"columns": columns,
+            "pk": pk,
+            "pk_indexes": None if columns[:len(pk)] == pk else tuple(columns.index(column) for column in pk),
+            "hash_column": hash_column,
+            "sql": upsert_row_sql(table_name, (*columns, hash_column) if hash_column else columns, pk, hash_column)}
+
+
+@lru_cache(maxsize=None)
+def existing_keys_sql(table_name, pk, keys_count):
+    if len(pk) == 1:
+        placeholders = ", ".join(["?" for _ in range(keys_count)])
+        return f"SELECT COUNT(*) FROM {table_name} WHERE {pk[0]} IN ({placeholders})"
+    # Join guidata dalle chiavi: un confronto "(a, b) IN (VALUES ...)" scandirebbe l'intera tabella
+    row_placeholder = f"({', '.join(['?' for _ in pk])})"
+    placeholders = ", ".join([row_placeholder for _ in range(keys_count)])
+    join_clause = " AND ".join([f"{table_name}.{column} = chiavi.column{index}"
+                                for index, column in enumerate(pk, start=1)])
+    return f"SELECT COUNT(*) FROM (VALUES {placeholders}) AS chiavi JOIN {table_name} ON {join_clause}"
+
+
+def count_existing_keys(table_name, pk, keys, database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    parameters = [value for key in keys for value in key]
+    return connection.execute(existing_keys_sql(table_name, tuple(pk), len(keys)), parameters).fetchone()[0]
+
+
+@lru_cache(maxsize=None)
+def changed_keys_sql(table_name, pk, hash_column, keys_count):
+    row_placeholder = f"({', '.join(['?' for _ in range(len(pk) + 1)])})"
+    placeholders = ", ".join([row_placeholder for _ in range(keys_count)])
+    join_clause = " AND ".join([f"{table_name}.{column} = chiavi.column{index}"
+                                for index, column in enumerate(pk, start=1)])
+    key_columns = ", ".join([f"chiavi.column{index}" for index in range(1, len(pk) + 1)])
+    return (f"SELECT {key_columns}, {table_name}.{pk[0]} IS NOT NULL FROM (VALUES {placeholders}) AS chiavi "
+            f"LEFT JOIN {table_name} ON {join_clause} "
+            f"WHERE {table_name}.{hash_column} IS NOT chiavi.column{len(pk) + 1}")
+
+
+def changed_keys(table_name, pk, hash_column, keyed_hashes, database_handler=None):
+    """
+    Which of the given (key, hash) pairs are new or differ from the stored rows, in one query:
+    `key` is the tuple of primary key values. Returns {key: whether the row already exists} for the keys to write.
+    """
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    parameters = [value for key, hash_value in keyed_hashes for value in (*key, hash_value)]
+    rows = connection.execute(changed_keys_sql(table_name, tuple(pk), hash_column, len(keyed_hashes)), parameters)
+    return {tuple(row[:-1]): bool(row[-1]) for row in rows}
+
+
+def upsert_rows(table_name, rows, database_handler=None, chunk_size=500):
+    """
+    Write a whole list of prepared rows with INSERT ... ON CONFLICT DO UPDATE ... WHERE changed.
+    Rows sharing a key are collapsed (the last one wins). On a table with a content hash the stored hashes
+    are compared first and only the new or changed rows are sent to the upsert. Returns the number of
+    inserted, updated and unchanged rows; the caller owns the transaction.
+    """
+    start = perf_counter()
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    plan = table_upsert_plan(table_name)
+    columns, pk, pk_indexes, hash_column, sql = (plan["columns"], plan["pk"], plan["pk_indexes"],
+                                                 plan["hash_column"], plan["sql"])
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    unique_rows = {}
+    for row in rows:
+        values = tuple(map(row.get, columns))
+        key = values[:len(pk)] if pk_indexes is None else tuple(values[index] for index in pk_indexes)
+        unique_rows[key] = (*values, row_hash(*values)) if hash_column else values
+    items = list(unique_rows.items())
+
+    chunk_size = max(1, min(chunk_size, SQLITE_MAX_VARIABLES // (len(pk) + 1 if hash_column else len(pk))))
+    for index in range(0, len(items), chunk_size):
+        chunk = items[index:index + chunk_size]
+        if hash_column:
+            to_write = changed_keys(table_name, pk, hash_column, [(key, values[-1]) for key, values in chunk],
+                                    database_handler)
+            if to_write:
+                connection.executemany(sql, [values for key, values in chunk if key in to_write])
+            updated = sum(to_write.values())
+            counts["inserted"] += len(to_write) - updated
+            counts["updated"] += updated
+            counts["unchanged"] += len(chunk) - len(to_write)
+            continue
+        existing = count_existing_keys(table_name, pk, [key for key, _ in chunk], database_handler)
+        # rowcount conta solo le righe della tabella, non quelle scritte dai trigger (registro e riepiloghi)
+        changed = connection.executemany(sql, [values for _, values in chunk]).rowcount
+        inserted = len(chunk) - existing
+        counts["inserted"] += inserted
+        counts["updated"] += changed - inserted
+        counts["unchanged"] += len(chunk) - changed
+
+    metrics = get_metrics()
+    metrics.observe("db_upsert_seconds", perf_counter() - start, table=table_name)
+    for result, amount in counts.items():
+        metrics.increment("db_rows_total", amount, table=table_name, result=result)
+    logger.debug("DatabaseHandler: Tabella '%s' -> %d righe inserite, %d aggiornate, %d già aggiornate.",
+                 table_name, counts["inserted"], counts["updated"], counts["unchanged"])
+    return counts
+
+
+def migrate_hash_column(table_name, table_model, connection):
+    """
+    Add the content hash column to a table created before it existed and fill it from the stored rows,
+    so the first upsert after the upgrade does not rewrite every row. The triggers of the table are
+    dropped first, so the backfill is not logged as a change; create_tables creates them again.
+    """
+    hash_column = table_model.get("hash_column")
+    if not hash_column:
+        return
+    existing_columns = {row[1] for row in connection.execute(f"PRAGMA table_info({table_name})")}
+    if hash_column in existing_columns:
+        return
+    triggers = connection.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?",
+                                  (table_name,)).fetchall()
+    for trigger in triggers:
+        connection.execute(f"DROP TRIGGER {trigger[0]}")
+    columns = ", ".join(col[0] for col in table_model["columns"])
+    connection.execute(f"ALTER TABLE {table_name} ADD COLUMN {hash_column} TEXT")
+    connection.execute(f"UPDATE {table_name} SET {hash_column} = row_hash({columns})")
+    logger.info("DatabaseHandler: Aggiunta la colonna '%s' alla tabella '%s'.", hash_column, table_name)
 
 
 def create_tables(tables_model_structure, database_handler=None):
     database_handler = validate_database_handler(database_handler)
     connection = database_handler.get_db_connection()
     for table_name in tables_model_structure.keys():
+        table_exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                          (table_name,)).fetchone() is not None
         sql = create_table_sql(table_name, tables_model_structure[table_name])
         connection.execute(sql)
+        for index_sql in create_indexes_sql(table_name, tables_model_structure[table_name]):
+            connection.execute(index_sql)
+        if table_exists:
+            migrate_hash_column(table_name, tables_model_structure[table_name], connection)
+        sync_triggers(table_name, tables_model_structure[table_name], connection)
+        if not table_exists and "populate" in tables_model_structure[table_name]:
+            # Tabella derivata aggiunta a un database esistente: viene riempita dai dati già presenti
+            connection.execute(tables_model_structure[table_name]["populate"])
         connection.commit()
-        print(f"DatabaseHandler: La tabella '{table_name}' è stata creata con successo!")
+        logger.info("DatabaseHandler: La tabella '%s' è stata creata con successo!", table_name)
+    for view_name, select_sql in views_model().items():
+        connection.execute(create_view_sql(view_name, select_sql))
+    connection.commit()
 
 
 def retrieve_classe_ids(scuola_id, database_handler=None):
@@ -172,3 +837,181 @@ def retrieve_classe_ids(scuola_id, database_handler=None):
     query = "SELECT CLID FROM classi WHERE COSCUO = ?"
     classe_ids = [row[0] for row in connection.execute(query, (scuola_id,)).fetchall()]
     return classe_ids
+
+
+def unit_key(*key_parts):
+    """
+    Key of a work unit in the `checkpoint` table: its parts joined by "/" (a class is "COSCUO/CLID").
+    """
+    return "/".join(str(part) for part in key_parts)
+
+
+def retrieve_checkpoint(database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    return {(row[0], row[1]) for row in connection.execute("SELECT UNIT, UNIT_KEY FROM checkpoint").fetchall()}
+
+
+def clear_checkpoint(database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    connection.execute("DELETE FROM checkpoint")
+    connection.commit()
+
+
+def retrieve_fingerprints(scuola_id=None, database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    query = "SELECT CLID, COSCUO, FINGERPRINT FROM sincronizzazioni"
+    if scuola_id is None:
+        rows = connection.execute(query).fetchall()
+    else:
+        rows = connection.execute(f"{query} WHERE COSCUO = ?", (scuola_id,)).fetchall()
+    return {(row[0], row[1]): row[2] for row in rows}
+
+
+def retrieve_export_cursor(export_name, database_handler=None):
+    """
+    Last change-log sequence covered by the named export, or None if it never ran.
+    """
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    row = connection.execute("SELECT LAST_SEQ FROM esportazioni WHERE NOME = ?", (export_name,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def store_export_cursor(export_name, last_seq, exported_at, database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    connection.execute("INSERT INTO esportazioni (NOME, LAST_SEQ, EXPORTED_AT) VALUES (?, ?, ?) "
+                       "ON CONFLICT (NOME) DO UPDATE SET LAST_SEQ = excluded.LAST_SEQ, "
+                       "EXPORTED_AT = excluded.EXPORTED_AT", (export_name, last_seq, exported_at))
+    connection.commit()
+
+
+def retrieve_last_change(database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    return connection.execute("SELECT COALESCE(MAX(SEQ), 0) FROM modifiche").fetchone()[0]
+
+
+def remove_export_cursor(export_name, database_handler=None):
+    """
+    Forget a registered export; returns False if there was none with that name.
+    """
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    cursor = connection.execute("DELETE FROM esportazioni WHERE NOME = ?", (export_name,))
+    connection.commit()
+    return cursor.rowcount > 0
+
+
+def prune_change_log(database_handler=None):
+    """
+    Delete the change-log entries already covered by every registered export, or all of them when no
+    export is registered; returns how many.
+    """
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    cursor = connection.execute("DELETE FROM modifiche WHERE NOT EXISTS (SELECT 1 FROM esportazioni) "
+                                "OR SEQ <= (SELECT MIN(LAST_SEQ) FROM esportazioni)")
+    connection.commit()
+    return cursor.rowcount
+
+
+def retrieve_riepilogo_classe(classe_id, scuola_id, database_handler=None):
+    """
+    Summary of one class (adopted books, books to buy, their total price, prices still missing, new
+    adoptions) read from riepilogo_classi by its key, or None if the class has no adoptions.
+    """
+    row = select_row("riepilogo_classi", ("CLID", "COSCUO"), (classe_id, scuola_id), database_handler)
+    return dict(row) if row is not None else None
+
+
+def retrieve_riepilogo_scuola(scuola_id, database_handler=None):
+    """
+    Summary of one school, the sums of its class summaries, or None if it has no adoptions.
+    """
+    row = select_row("riepilogo_scuole", "COSCUO", scuola_id, database_handler)
+    return dict(row) if row is not None else None
+
+
+def retrieve_riepiloghi_classi(scuola_id, database_handler=None):
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    rows = connection.execute("SELECT * FROM riepilogo_classi WHERE COSCUO = ?", (scuola_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def retrieve_libri_da_acquistare(classe_id, scuola_id, database_handler=None):
+    """
+    Books the class has to buy, with their price (None when still unknown).
+    """
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    query = ("SELECT a.ISBN, a.DESC_DISCIPLINA, l.Title, l.Author, l.Publisher, l.Price FROM adozioni a "
+             "LEFT JOIN libri l ON l.EAN = a.ISBN WHERE a.CLID = ? AND a.COSCUO = ? AND a.DA_ACQUISTARE = 'Si'")
+    return [dict(row) for row in connection.execute(query, (classe_id, scuola_id)).fetchall()]
+
+
+def refresh_riepiloghi(database_handler=None):
+    """
+    Rebuild both summary tables from scratch; the triggers keep them current afterwards.
+    """
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    connection.execute("DELETE FROM riepilogo_classi")
+    connection.execute(riepilogo_classi_sql("1"))
+    connection.commit()
+
+
+def fts_query(text):
+    """
+    Turn free text typed by a user into an FTS5 query: every word must match, the last one as a prefix,
+    and the FTS5 operators in the input are taken literally. Punctuation splits words as the unicode61
+    tokenizer does, so "dell'arte" looks for "dell" and "arte".
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_libri(text, limit=20, adozioni_limit=50, database_handler=None):
+    """
+    Books whose title, author or publisher match `text`, best first (bm25, title weighted over author
+    over publisher), each with the number of classes adopting it and up to `adozioni_limit` of those
+    classes with their school.
+    """
+    query = fts_query(text)
+    if query is None:
+        return []
+    database_handler = validate_database_handler(database_handler)
+    connection = database_handler.get_db_connection()
+    start = perf_counter()
+    libri = [dict(row) for row in connection.execute(
+        "SELECT l.EAN, l.Title, l.Author, l.Publisher, l.Price, bm25(libri_fts, 10.0, 5.0, 1.0) AS RANK "
+        "FROM libri_fts JOIN libri l ON l.rowid = libri_fts.rowid "
+        "WHERE libri_fts MATCH ? ORDER BY RANK LIMIT ?", (query, limit)).fetchall()]
+    if libri:
+        for libro in libri:
+            libro["ADOZIONI_TOTALI"] = 0
+            libro["ADOZIONI"] = []
+        libri_by_ean = {libro["EAN"]: libro for libro in libri}
+        placeholders = ", ".join(["?" for _ in libri_by_ean])
+        rows = connection.execute(
+            "SELECT * FROM (SELECT a.ISBN, a.CLID, a.COSCUO, c.CLASSE, c.SEZION, c.DESCOMB, s.NOMSCU, s.LOCSCU, "
+            "COUNT(*) OVER (PARTITION BY a.ISBN) AS TOTALE, "
+            "ROW_NUMBER() OVER (PARTITION BY a.ISBN ORDER BY a.COSCUO, a.CLID) AS POSIZIONE "
+            "FROM adozioni a LEFT JOIN classi c ON c.CLID = a.CLID LEFT JOIN scuole s ON s.COSCUO = a.COSCUO "
+            f"WHERE a.ISBN IN ({placeholders})) WHERE POSIZIONE <= ?", (*libri_by_ean, adozioni_limit)).fetchall()
+        for row in rows:
+            libro = libri_by_ean[row["ISBN"]]
+            libro["ADOZIONI_TOTALI"] = row["TOTALE"]
+            libro["ADOZIONI"].append({key: row[key] for key in ("CLID", "COSCUO", "CLASSE", "SEZION", "DESCOMB",
+                                                                "NOMSCU", "LOCSCU")})
+    get_metrics().observe("db_search_seconds", perf_counter() - start)
+    logger.debug("DatabaseHandler: Ricerca '%s' -> %d libri.", query, len(libri))
+    return libri
@@ -0,0 +1,25 @@
+import socket
+import pytest
+from api.adozioni_amazon_api import (configure_session_pool, configure_rate_limiter, configure_response_cache,
+                                     get_libro, retry_session)
+from api.rate_limiter import RateLimitExceeded
+
+
+def refused_url():
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{server.getsockname()[1]}"
+
+
+def test_refused_connections_end_in_rate_limit_exceeded(monkeypatch):
+    monkeypatch.setattr("api.adozioni_amazon_api.get_public_ip", lambda: None)
+    configure_response_cache(enabled=False)
+    configure_session_pool(url=refused_url(), warm_up=True)
+    configure_rate_limiter(base_delay=0.001, max_delay=0.002, max_retries=2)
+    try:
+        with pytest.raises(RateLimitExceeded):
+            retry_session(get_libro, {"libro_id": 9788823365957})
+    finally:
+        configure_session_pool()
+        configure_rate_limiter()
+        configure_response_cache()
@@ -0,0 +1,32 @@
+import pytest
+from api.adozioni_amazon_async_api import fetch_libri
+from api.rate_limiter import RateLimitController, RateLimitExceeded
+from benchmarks.stub_server import StubAPI, StubConfig, isbn
+
+pytest.importorskip("aiohttp")
+
+
+def fast_rate_limiter(max_retries):
+    return RateLimitController(rate=500.0, max_rate=500.0, min_rate=500.0, concurrency=10, min_concurrency=10,
+                               base_delay=0.001, max_delay=0.005, max_retries=max_retries)
+
+
+@pytest.fixture
+def throttling_stub():
+    stub = StubAPI(StubConfig(latency=0.001, jitter=0.0, throttle_probability=0.5, seed=3)).start()
+    yield stub
+    stub.close()
+
+
+def test_throttled_lookups_are_retried(throttling_stub):
+    libro_ids = [isbn(index) for index in range(20)]
+    libri = fetch_libri(libro_ids, url=throttling_stub.url, rate_limiter=fast_rate_limiter(max_retries=30))
+    assert throttling_stub.get_stats()["throttled"] > 0
+    assert sorted(libri) == libro_ids
+    assert all(libro[0]["ItemAttributes"]["EAN"] == libro_id for libro_id, libro in libri.items())
+
+
+def test_exhausted_retries_raise_instead_of_returning_none(throttling_stub):
+    throttling_stub.config.throttle_probability = 1.0
+    libri = fetch_libri([isbn(0)], url=throttling_stub.url, rate_limiter=fast_rate_limiter(max_retries=2))
+    assert isinstance(libri[isbn(0)], RateLimitExceeded)
@@ -0,0 +1,37 @@
+from threading import Event, Thread
+from time import sleep
+from control.libri_registry import LibriRegistry
+
+
+def test_failed_lookup_is_not_cached():
+    registry = LibriRegistry()
+    assert registry.get_or_fetch("978", lambda libro_id: None) is None
+    assert registry.get_or_fetch("978", lambda libro_id: {"EAN": libro_id}) == {"EAN": "978"}
+    assert "978" in registry
+    assert registry.get_stats() == {"fetched": 1, "hits": 0, "coalesced": 0, "failed": 1}
+
+
+def test_concurrent_callers_share_the_in_flight_fetch():
+    registry = LibriRegistry()
+    started, release = Event(), Event()
+    calls = []
+
+    def slow_fetch(libro_id):
+        calls.append(libro_id)
+        started.set()
+        release.wait(5)
+        return None
+
+    results = []
+    first = Thread(target=lambda: results.append(registry.get_or_fetch("978", slow_fetch)))
+    first.start()
+    started.wait(5)
+    waiter = Thread(target=lambda: results.append(registry.get_or_fetch("978", slow_fetch)))
+    waiter.start()
+    while registry.get_stats()["coalesced"] == 0:
+        sleep(0.001)
+    release.set()
+    first.join()
+    waiter.join()
+    assert results == [None, None]
+    assert calls == ["978"]
@@ -0,0 +1,32 @@
+from threading import Event
+from utils.metrics import configure_metrics, METRIC_PREFIX
+from utils.pipeline import Pipeline, Stage
+
+
+def prometheus_types(payload):
+    return [line.split()[2] for line in payload.splitlines() if line.startswith("# TYPE ")]
+
+
+def test_prometheus_declares_each_metric_family_once(tmp_path):
+    metrics = configure_metrics()
+    started, release = Event(), Event()
+
+    def slow(item):
+        started.set()
+        release.wait(5)
+        return item
+
+    pipeline = Pipeline([Stage("Lenta", slow, 1), Stage("Fine", lambda item: item, 1)], max_queue_size=10).start()
+    try:
+        for item in range(5):
+            pipeline.put(item)
+        started.wait(5)  # La fase ha già prelevato un elemento e registrato la profondità della coda
+        filename = tmp_path / "metriche.prom"
+        metrics.to_prometheus(str(filename))  # Export mentre i gauge delle code sono registrati
+    finally:
+        release.set()
+        pipeline.join()
+
+    types = prometheus_types(filename.read_text(encoding="utf-8"))
+    assert f"{METRIC_PREFIX}queue_depth" in types
+    assert len(types) == len(set(types)), sorted(name for name in types if types.count(name) > 1)
@@ -0,0 +1,130 @@
+import atexit
+import logging
+import sys
+from collections.abc import Mapping
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener
+from os import environ
+from queue import SimpleQueue
+from threading import RLock
+
+ROOT_LOGGER = "adozioni"
+DEFAULT_FORMAT = "%(asctime)s %(levelname)-7s %(threadName)s %(name)s: %(message)s"
+
+_listener = None
+_listener_lock = RLock()
+
+
+def get_logger(name):
+    """
+    Logger of a module, e.g. `get_logger(__name__)`: every logger hangs off the `adozioni` root,
+    so one call to configure_logging controls the api, control and model modules together.
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class Truncated:
+    """
+    Lazy, bounded rendering of a payload: nothing is formatted unless the record is emitted,
+    and then at most `limit` characters of its repr are.
+    """
+
+    __slots__ = ("payload", "limit")
+
+    def __init__(self, payload, limit=200):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        text = repr(self.payload)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... ({len(text)} caratteri)"
+
+    __repr__ = __str__
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let through one record in `extra={"sample": n}` per call site; records without it always pass.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = RLock()
+        self._counters = {}
+
+    def filter(self, record):
+        every = getattr(record, "sample", None)
+        if not every or every <= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = count()
+        return next(counter) % every == 0
+
+
+IMMUTABLE_ARG_TYPES = (str, int, float, bool, bytes, type(None))
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the listener thread instead of the thread that logged.
+    A message whose arguments are all immutable scalars is merged with them there too; any other argument
+    (a row dict, a list, a Truncated payload) could change before then, so that message is merged here.
+    """
+
+    def prepare(self, record):
+        if record.args:
+            args = record.args.values() if isinstance(record.args, Mapping) else record.args
+            if not all(isinstance(arg, IMMUTABLE_ARG_TYPES) for arg in args):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
+def configure_logging(level=None, stream=None, fmt=DEFAULT_FORMAT, queued=True):
+    """
+    Send the `adozioni` loggers to `stream` (stderr by default) at `level`, which defaults to the
+    ADOZIONI_LOG_LEVEL environment variable or WARNING. When `queued`, records are only enqueued by the
+    calling thread and formatted and written by a single listener thread.
+    """
+    global _listener
+    level = level if level is not None else environ.get("ADOZIONI_LOG_LEVEL", "WARNING")
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(fmt))
+
+    with _listener_lock:
+        shutdown_logging()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        if queued:
+            queue = SimpleQueue()
+            handler = DeferredQueueHandler(queue)
+            _listener = QueueListener(queue, stream_handler, respect_handler_level=True)
+            _listener.start()
+        else:
+            handler = stream_handler
+        handler.addFilter(SamplingFilter())
+        logger.addHandler(handler)
+    return logger
+
+
+def shutdown_logging():
+    """
+    Stop the listener thread after it has written every record already enqueued.
+    """
+    global _listener
+    with _listener_lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+atexit.register(shutdown_logging)
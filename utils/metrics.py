@@ -0,0 +1,282 @@
+import json
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import environ
+from threading import RLock
+from time import perf_counter
+from utils.time_utils import measureTime, measureElapsed
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+METRIC_PREFIX = "adozioni_"
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram in the Prometheus layout: per-bucket counts plus sum, count, min and max.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum, histogram.count, histogram.min, histogram.max = self.sum, self.count, self.min, self.max
+        return histogram
+
+    def merge(self, other):
+        """
+        Add the observations of another histogram with the same buckets.
+        """
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min if other.min is not None else self.min)
+        self.max = other.max if self.max is None else max(self.max, other.max if other.max is not None else self.max)
+
+    def quantile(self, q):
+        """
+        Estimate of the q-th quantile, interpolated linearly inside the bucket that holds it
+        and clamped to the observed minimum and maximum.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = max(self.buckets[index - 1] if index > 0 else self.min, self.min)
+                upper = min(self.buckets[index] if index < len(self.buckets) else self.max, self.max)
+                return lower + (upper - lower) * max(0.0, rank - seen) / bucket_count
+            seen += bucket_count
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99)}
+
+
+def labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters, gauges and latency histograms, each keyed by name and labels
+    (stage, endpoint, table, ...). Recording is a dictionary update under one lock, and the whole
+    registry can be exported as a JSON summary or in the Prometheus text format.
+    Setting ADOZIONI_METRICS=0 turns every recording call into a no-op.
+    """
+
+    def __init__(self, enabled=True):
+        self._enabled = enabled and environ.get("ADOZIONI_METRICS", "1") != "0"
+        self._lock = RLock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._gauge_functions = {}
+        self._tupleTime = measureTime()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def increment(self, name, amount=1, **labels):
+        if not self._enabled:
+            return
+        key = (name, labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        if not self._enabled:
+            return
+        with self._lock:
+            self._gauges[(name, labels_key(labels))] = value
+
+    def register_gauge(self, name, function, **labels):
+        """
+        Gauge read by calling `function` at export time, e.g. the current depth of a queue.
+        """
+        if not self._enabled:
+            return
+        with self._lock:
+            self._gauge_functions[(name, labels_key(labels))] = function
+
+    def unregister_gauge(self, name, **labels):
+        """
+        Stop polling a registered gauge, keeping its last value.
+        """
+        key = (name, labels_key(labels))
+        with self._lock:
+            function = self._gauge_functions.pop(key, None)
+            if function is not None:
+                self._gauges[key] = function()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self._enabled:
+            return
+        key = (name, labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the duration of the block in seconds, also when it raises.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def get_histogram(self, name, **labels):
+        """
+        Copy of a histogram; without labels, every label set recorded under `name` merged together.
+        """
+        with self._lock:
+            if labels:
+                histogram = self._histograms.get((name, labels_key(labels)))
+                return histogram.copy() if histogram is not None else None
+            merged = None
+            for (histogram_name, _), histogram in self._histograms.items():
+                if histogram_name != name:
+                    continue
+                if merged is None:
+                    merged = histogram.copy()
+                else:
+                    merged.merge(histogram)
+            return merged
+
+    def get_counter(self, name, **labels):
+        """
+        Value of a counter; without labels, the sum over every label set recorded under `name`.
+        """
+        with self._lock:
+            if labels:
+                return self._counters.get((name, labels_key(labels)), 0)
+            return sum(value for (counter_name, _), value in self._counters.items() if counter_name == name)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self._tupleTime = measureTime()
+
+    def _snapshot(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+            for key, function in self._gauge_functions.items():
+                try:
+                    gauges[key] = function()
+                except Exception:
+                    continue
+            wall_time, cpu_time = measureElapsed(self._tupleTime)
+            gauges[("run_wall_seconds", ())] = wall_time
+            gauges[("run_cpu_seconds", ())] = cpu_time
+            for (name, key), busy in self._counters.items():
+                workers = gauges.get(("workers", key))
+                if name == "busy_seconds_total" and workers and wall_time > 0:
+                    gauges[("worker_utilization", key)] = busy / (workers * wall_time)
+            histograms = {key: histogram.copy() for key, histogram in self._histograms.items()}
+            return dict(self._counters), gauges, histograms
+
+    def to_dict(self):
+        counters, gauges, histograms = self._snapshot()
+        histograms = {key: histogram.to_dict() for key, histogram in histograms.items()}
+
+        def group(values):
+            grouped = {}
+            for (name, key), value in sorted(values.items(), key=lambda item: item[0]):
+                grouped.setdefault(name, []).append(dict(key, value=value) if key else {"value": value})
+            return grouped
+
+        return {"counters": group(counters), "gauges": group(gauges), "histograms": group(histograms)}
+
+    def to_json(self, filename=None):
+        payload = json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+        if filename is not None:
+            with open(filename, "w", encoding="utf-8") as file:
+                file.write(payload)
+        return payload
+
+    def to_prometheus(self, filename=None):
+        counters, gauges, histograms = self._snapshot()
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+                for (value_name, key), value in sorted(values.items()):
+                    if value_name == name:
+                        lines.append(f"{METRIC_PREFIX}{name}{format_labels(key)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+            for (value_name, key), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+                if value_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip([*histogram.buckets, "+Inf"], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{format_labels(key, [('le', str(bound))])} "
+                                 f"{cumulative}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{format_labels(key)} {histogram.sum}")
+                lines.append(f"{METRIC_PREFIX}{name}_count{format_labels(key)} {histogram.count}")
+        payload = "\n".join(lines) + "\n"
+        if filename is not None:
+            with open(filename, "w", encoding="utf-8") as file:
+                file.write(payload)
+        return payload
+
+
+_metrics = None
+_metrics_lock = RLock()
+
+
+def get_metrics():
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
+
+
+def configure_metrics(**kwargs):
+    """
+    Replace the process-wide registry; `configure_metrics(enabled=False)` disables recording.
+    """
+    global _metrics
+    with _metrics_lock:
+        _metrics = MetricsRegistry(**kwargs)
+        return _metrics
@@ -0,0 +1,149 @@
+from collections import namedtuple
+from queue import Queue
+from threading import Thread, RLock
+from time import perf_counter
+from utils.log_utils import get_logger, Truncated
+from utils.metrics import get_metrics, SIZE_BUCKETS
+
+Stage = namedtuple("Stage", ["name", "function", "workers"])
+StageError = namedtuple("StageError", ["stage", "item", "error"])
+
+_STOP = object()
+
+logger = get_logger(__name__)
+
+
+class Pipeline:
+    """
+    Chain of stages connected by bounded queues. Each stage function receives one item and
+    returns the item for the next stage (None to drop it), or is a generator yielding any number
+    of them. A full queue blocks the stage feeding it, so memory stays flat and the slowest stage
+    sets the pace. Items produced by the last stage are dropped unless `collect` is set.
+    """
+
+    def __init__(self, stages, max_queue_size=100, collect=False):
+        self._stages = [stage if isinstance(stage, Stage) else Stage(*stage) for stage in stages]
+        self._queues = [Queue(maxsize=max_queue_size) for _ in self._stages]
+        self._collect = collect
+        self._lock = RLock()
+        self._alive = [stage.workers for stage in self._stages]
+        self._threads = []
+        self._errors = []
+        self._outputs = []
+        self._processed = [0 for _ in self._stages]
+        self._closed = False
+        self._metrics = get_metrics()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return self
+            for index, stage in enumerate(self._stages):
+                self._metrics.set_gauge("workers", stage.workers, stage=stage.name)
+                self._metrics.register_gauge("queue_depth", self._queues[index].qsize, stage=stage.name)
+                for worker_index in range(stage.workers):
+                    thread = Thread(target=self._run, args=(index,), name=f"{stage.name}-{worker_index}",
+                                    daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        return self
+
+    def put(self, item):
+        """
+        Feed an item to the first stage; blocks while the first queue is full.
+        """
+        self.start()
+        self._queues[0].put(item)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.start()
+        for _ in range(self._stages[0].workers):
+            self._queues[0].put(_STOP)
+
+    def join(self):
+        """
+        Close the input, wait for every stage to drain and return the errors collected per item.
+        """
+        self.close()
+        for thread in list(self._threads):
+            thread.join()
+        for stage in self._stages:
+            self._metrics.unregister_gauge("queue_depth", stage=stage.name)
+        with self._lock:
+            return list(self._errors)
+
+    def run(self, items):
+        self.start()
+        for item in items:
+            self.put(item)
+        return self.join()
+
+    def _emit(self, index, outputs):
+        """
+        Pass the outputs on and return the seconds spent blocked on the next, full queue.
+        """
+        blocked = 0.0
+        if outputs is None:
+            return blocked
+        for output in outputs if hasattr(outputs, "__next__") else [outputs]:
+            if index + 1 < len(self._stages):
+                start = perf_counter()
+                self._queues[index + 1].put(output)
+                blocked += perf_counter() - start
+            elif self._collect:
+                with self._lock:
+                    self._outputs.append(output)
+        return blocked
+
+    def _run(self, index):
+        stage = self._stages[index]
+        queue = self._queues[index]
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                break
+            self._metrics.observe("queue_depth_observed", queue.qsize(), SIZE_BUCKETS, stage=stage.name)
+            start = perf_counter()
+            blocked = 0.0
+            try:
+                blocked = self._emit(index, stage.function(item))
+            except Exception as error:
+                logger.error("Pipeline: Errore nella fase '%s' per '%s': %r", stage.name, Truncated(item), error)
+                with self._lock:
+                    self._errors.append(StageError(stage.name, item, error))
+                self._metrics.increment("errors_total", stage=stage.name)
+            busy = perf_counter() - start - blocked
+            self._metrics.observe("stage_seconds", busy, stage=stage.name)
+            self._metrics.increment("busy_seconds_total", busy, stage=stage.name)
+            self._metrics.increment("blocked_seconds_total", blocked, stage=stage.name)
+            with self._lock:
+                self._processed[index] += 1
+
+        with self._lock:
+            self._alive[index] -= 1
+            last_worker = self._alive[index] == 0
+        if last_worker and index + 1 < len(self._stages):
+            for _ in range(self._stages[index + 1].workers):
+                self._queues[index + 1].put(_STOP)
+
+    def queue_sizes(self):
+        return {stage.name: queue.qsize() for stage, queue in zip(self._stages, self._queues)}
+
+    def get_stats(self):
+        with self._lock:
+            return {stage.name: processed for stage, processed in zip(self._stages, self._processed)}
+
+    def get_outputs(self):
+        with self._lock:
+            return list(self._outputs)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+        return False
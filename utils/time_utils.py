@@ -27,7 +27,15 @@ def timeDeltaString(start, end):
     delta = delta - seconds
     milliseconds = int(delta * 1000)
 
-    return f"{hours}:{minutes:0<2d}:{seconds:0<2d}.{milliseconds:0<3d}"
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+
+def measureElapsed(tupleTime):
+    """
+    Wall and CPU seconds elapsed since the first measureTime of tupleTime.
+    """
+    tupleTime = measureTime(tupleTime)
+    return tupleTime[0][1] - tupleTime[0][0], tupleTime[1][1] - tupleTime[1][0]
 
 
 def measureTimeString(tupleTime=None):
@@ -0,0 +1,154 @@
+from collections import namedtuple
+from itertools import count
+from queue import Queue, Empty
+from threading import Thread, RLock, local
+from time import perf_counter
+from utils.log_utils import get_logger, Truncated
+from utils.metrics import get_metrics
+
+TaskResult = namedtuple("TaskResult", ["task_id", "args", "result", "error"])
+
+_STOP = object()
+_worker_state = local()
+
+logger = get_logger(__name__)
+
+
+def get_worker_context():
+    """
+    Return the object built by the pool initializer for the current worker thread (None outside a pool).
+    """
+    return getattr(_worker_state, "context", None)
+
+
+class WorkerPool:
+    """
+    Bounded pool of long-lived worker threads fed by a shared work queue.
+    Every worker picks the next task as soon as it is free, so a slow task only occupies its own slot.
+    """
+
+    def __init__(self, num_workers=15, max_queue_size=0, initializer=None, finalizer=None, name="Worker"):
+        if num_workers < 1:
+            raise ValueError("num_workers deve essere almeno 1")
+        self._num_workers = num_workers
+        self._initializer = initializer
+        self._finalizer = finalizer
+        self._name = name
+        self._queue = Queue(maxsize=max_queue_size)
+        self._lock = RLock()
+        self._results = {}
+        self._task_ids = count()
+        self._threads = []
+        self._closed = False
+        self._metrics = get_metrics()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return self
+            for index in range(self._num_workers):
+                thread = Thread(target=self._run, name=f"{self._name}-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._metrics.set_gauge("workers", self._num_workers, pool=self._name)
+            self._metrics.register_gauge("queue_depth", self._queue.qsize, pool=self._name)
+            logger.debug("WorkerPool: Avviati %d worker!", self._num_workers)
+        return self
+
+    def submit(self, function, *args, **kwargs):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("WorkerPool: Il pool è già stato chiuso!")
+            task_id = next(self._task_ids)
+        self.start()
+        self._queue.put((task_id, function, args, kwargs))
+        return task_id
+
+    def map(self, function, iterable):
+        return [self.submit(function, item) for item in iterable]
+
+    def _run(self):
+        context = None
+        if self._initializer is not None:
+            try:
+                context = self._initializer()
+            except Exception as error:
+                logger.error("WorkerPool: Inizializzazione del worker fallita: %r", error)
+        _worker_state.context = context
+        try:
+            while True:
+                item = self._queue.get()
+                try:
+                    if item is _STOP:
+                        break
+                    task_id, function, args, kwargs = item
+                    start = perf_counter()
+                    try:
+                        result = TaskResult(task_id, args, function(*args, **kwargs), None)
+                    except Exception as error:
+                        logger.error("WorkerPool: Errore nel task %d %s: %r", task_id, Truncated(args), error)
+                        result = TaskResult(task_id, args, None, error)
+                        self._metrics.increment("errors_total", pool=self._name)
+                    elapsed = perf_counter() - start
+                    self._metrics.observe("task_seconds", elapsed, pool=self._name)
+                    self._metrics.increment("busy_seconds_total", elapsed, pool=self._name)
+                    with self._lock:
+                        self._results[task_id] = result
+                finally:
+                    self._queue.task_done()
+        finally:
+            _worker_state.context = None
+            if self._finalizer is not None and context is not None:
+                self._finalizer(context)
+
+    def join(self):
+        """
+        Wait for every queued task and return the results collected so far, in submission order.
+        """
+        self._queue.join()
+        with self._lock:
+            return [self._results[task_id] for task_id in sorted(self._results)]
+
+    def cancel_pending(self):
+        cancelled = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+            if item is not _STOP:
+                cancelled += 1
+            self._queue.task_done()
+        return cancelled
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        if cancel_pending:
+            cancelled = self.cancel_pending()
+            if cancelled:
+                logger.info("WorkerPool: Annullati %d task in attesa!", cancelled)
+        for _ in threads:
+            self._queue.put(_STOP)
+        if wait:
+            for thread in threads:
+                thread.join()
+            self._metrics.unregister_gauge("queue_depth", pool=self._name)
+            logger.debug("WorkerPool: Tutti i worker sono terminati!")
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True, cancel_pending=exc_type is not None)
+        return False